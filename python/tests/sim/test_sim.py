@@ -2,14 +2,19 @@
 # torii: UnusedElaboratable=no
 
 from contextlib           import contextmanager
+from threading            import Thread
+from unittest.mock        import patch
 
-from torii.hdl.ast        import Signal, Value, Statement
+from torii.hdl.ast        import Const, Signal, SignalDict, Value, Statement, signed
+from torii.hdl.cd         import ClockDomain
 from torii.hdl.dsl        import Module
 from torii.hdl.ir         import Fragment
-from torii.sim            import Settle, Simulator
+from torii.hdl.mem        import Memory
+from torii.hdl.xfrm       import EnableInserter
+from torii.sim            import Delay, Settle, Simulator
 from torii.util           import flatten
 
-from torii_sim_wasm       import WASMSimEngine
+from torii_sim_wasm       import Ticks, WASMConfig, WASMSimEngine, WaitUntil, wasmrtl
 
 from ..utils              import ToriiTestSuiteCase
 from .integration_harness import SimulatorIntegrationTestsMixin
@@ -82,3 +87,504 @@ class WASMSimulatorIntegrationTestCase(ToriiTestSuiteCase, SimulatorIntegrationT
 class WASMRegressionTestCase(ToriiTestSuiteCase, SimulatorRegressionTestMixin):
 	def get_simulator(self, dut) -> Simulator:
 		return Simulator(dut, engine = WASMSimEngine)
+
+class WASMSimEngineTestCase(ToriiTestSuiteCase):
+	def setUp(self):
+		self.m = Module()
+		self.counter = Signal(16)
+		self.m.d.sync += self.counter.eq(self.counter + 1)
+
+	def get(self, sim, signal):
+		state = sim._engine._state
+		return state.memory.get(state.get_signal(signal))
+
+	def test_run_cycles(self):
+		sim = Simulator(self.m, engine = WASMSimEngine)
+		sim.add_clock(1e-6)
+
+		with sim.write_vcd('test.vcd', 'test.gtkw', traces = [ self.counter ]):
+			sim._engine.run_cycles(20)
+			self.assertEqual(self.get(sim, self.counter), 20)
+
+		sim._engine.run_cycles(100)
+		self.assertEqual(self.get(sim, self.counter), 120)
+
+	def test_run_cycles_coroutine(self):
+		sim = Simulator(self.m, engine = WASMSimEngine)
+		sim.add_clock(1e-6)
+		seen = []
+
+		def process():
+			yield Delay(10.2e-6)
+			seen.append((yield self.counter))
+			yield Delay(1e-6)
+			seen.append((yield self.counter))
+
+		sim.add_process(process)
+		sim._engine.run_cycles(50)
+		self.assertEqual(seen, [ 10, 11 ])
+		self.assertEqual(self.get(sim, self.counter), 50)
+
+	def test_run_cycles_no_clock(self):
+		sim = Simulator(self.m, engine = WASMSimEngine)
+		with self.assertRaisesRegex(ValueError, r'^Slot \d+ is not driven by a clock$'):
+			sim._engine.run_cycles(1)
+
+	def test_fast_forward(self):
+		results = []
+		for fast_forward in (False, True):
+			m = Module()
+			m.domains.sync = sync = ClockDomain()
+			en      = Signal()
+			counter = Signal(16)
+			with m.If(en):
+				m.d.sync += counter.eq(counter + 1)
+
+			sim = Simulator(m, engine = WASMSimEngine)
+			sim.add_clock(1e-6)
+			sim._engine.fast_forward = fast_forward
+			seen = []
+
+			def process():
+				yield Delay(1e-3 + 0.2e-6)
+				seen.append((yield sync.clk))
+				yield en.eq(1)
+				yield Delay(5e-6)
+				seen.append((yield sync.clk))
+				seen.append((yield counter))
+
+			sim.add_process(process)
+			sim.run()
+			results.append((seen, sim._engine.now))
+
+		self.assertEqual(results[0], results[1])
+		self.assertEqual(results[1][0][2], 5)
+
+	def test_run_until_idle(self):
+		m = Module()
+		m.domains.sync = ClockDomain()
+		en      = Signal()
+		counter = Signal(16)
+		with m.If(en):
+			m.d.sync += counter.eq(counter + 1)
+
+		sim = Simulator(m, engine = WASMSimEngine)
+		sim.add_clock(1e-6)
+
+		def watchdog():
+			yield Delay(1)
+
+		sim.add_process(watchdog)
+		self.assertFalse(sim._engine.fast_forward)
+		sim.run_until(1e-3)
+		self.assertLessEqual(sim._engine.now, 1e9 + 0.5e6)
+		sim.run_until(2e-3)
+		self.assertLessEqual(sim._engine.now, 2e9 + 0.5e6)
+
+	def test_memory64(self):
+		mem  = Memory(width = 8, depth = 16, init = range(16))
+		data = Signal(8)
+		m    = Module()
+		m.submodules.rdport = rdport = mem.read_port(domain = 'comb')
+		m.submodules.counter = self.m
+		m.d.comb += rdport.addr.eq(self.counter)
+		m.d.sync += data.eq(rdport.data + 1)
+
+		sim = Simulator(m, engine = WASMSimEngine.with_config(WASMConfig(memory64 = True)))
+		sim.add_clock(1e-6)
+		seen = []
+
+		def process():
+			for _ in range(4):
+				yield Ticks(1)
+				yield Settle()
+				seen.append(((yield self.counter), (yield data)))
+
+		sim.add_process(process)
+		sim.run()
+		self.assertTrue(sim._engine._state.memory64)
+		self.assertIsNone(WASMSimEngine.config)
+		self.assertEqual(seen, [ (1, 1), (2, 2), (3, 3), (4, 4) ])
+
+	def test_many_slots(self):
+		m    = Module()
+		regs = [ Signal(8, reset = index % 256, name = f'r{index}') for index in range(20_000) ]
+		for reg in regs:
+			m.d.sync += reg.eq(reg + 1)
+
+		sim = Simulator(m, engine = WASMSimEngine)
+		sim.add_clock(1e-6)
+		sim._engine.run_cycles(3)
+
+		state = sim._engine._state
+		self.assertGreater(state.get_signal(regs[-1]), 16_000)
+		for index in (0, 8191, 8192, 16_383, 16_384, 19_999):
+			self.assertEqual(self.get(sim, regs[index]), (index + 3) % 256)
+
+	def test_run_cycles_threaded(self):
+		sim = Simulator(self.m, engine = WASMSimEngine)
+		sim.add_clock(1e-6)
+		engine = sim._engine
+		state  = engine._state
+		runner = state.get_runner('read', (self.counter,), lambda: wasmrtl._RHSValueCompiler.compile(
+			state, self.counter, mode = 'curr'
+		))
+
+		# The instance stays borrowed while the simulation runs with the GIL released, so this
+		# thread gets to run but can't touch the instance until it's done
+		errors = set()
+		cycles = 0
+		chunk  = 1000
+		while len(errors) < 2 and chunk <= 10_000_000:
+			thread = Thread(target = engine.run_cycles, args = (chunk,))
+			thread.start()
+			while thread.is_alive():
+				try:
+					runner()
+				except RuntimeError:
+					errors.add(RuntimeError)
+				try:
+					engine.memory.release()
+				except BufferError:
+					errors.add(BufferError)
+			thread.join()
+			cycles += chunk
+			chunk  *= 4
+
+		self.assertEqual(errors, {RuntimeError, BufferError})
+		self.assertEqual(runner(), cycles & 0xffff)
+		self.assertEqual(self.get(sim, self.counter), cycles & 0xffff)
+
+	def test_idle_domain(self):
+		en   = Signal()
+		a    = Signal(8)
+		b    = Signal(8)
+		m    = Module()
+		m.d.sync += b.eq(a)
+		seen = []
+
+		sim = Simulator(EnableInserter(en)(self.m), engine = WASMSimEngine)
+		sim.add_clock(1e-6)
+
+		def process():
+			yield Delay(3.2e-6)
+			seen.append((yield self.counter))
+			yield en.eq(1)
+			yield Delay(3e-6)
+			seen.append((yield self.counter))
+			yield en.eq(0)
+			yield Delay(3e-6)
+			seen.append((yield self.counter))
+
+		sim.add_process(process)
+		sim.run()
+		self.assertEqual(seen, [ 0, 3, 3 ])
+
+		sim = Simulator(m, engine = WASMSimEngine)
+		sim.add_clock(1e-6)
+
+		def process():
+			yield Delay(3.2e-6)
+			seen.append((yield b))
+			yield a.eq(5)
+			yield Delay(3e-6)
+			seen.append((yield b))
+			yield Delay(3e-6)
+			seen.append((yield b))
+
+		sim.add_process(process)
+		sim.run()
+		self.assertEqual(seen[3:], [ 0, 5, 5 ])
+
+	def test_enable_skip(self):
+		for reset_less in (False, True):
+			en   = Signal()
+			a    = Signal(8)
+			b    = Signal(8, reset = 3)
+			m    = Module()
+			m.domains.sync = sync = ClockDomain(reset_less = reset_less)
+			m.d.sync += b.eq(a)
+			seen = []
+
+			sim = Simulator(EnableInserter(en)(m), engine = WASMSimEngine)
+			sim.add_clock(1e-6)
+			state = sim._engine._state.memory
+
+			def process():
+				# `a` changes on every cycle, so only the enable keeps the domain from being run
+				for value in range(5):
+					yield a.eq(value)
+					yield Delay(1e-6)
+				seen.append((state.runs, (yield b)))
+				yield en.eq(1)
+				yield Delay(3e-6)
+				seen.append((yield b))
+				yield en.eq(0)
+				yield Delay(1e-6)
+				runs = state.runs
+				for value in range(5):
+					yield a.eq(value + 10)
+					yield Delay(1e-6)
+				seen.append((state.runs - runs, (yield b)))
+				if not reset_less:
+					yield sync.rst.eq(1)
+					yield Delay(1e-6)
+					seen.append((yield b))
+
+			sim.add_process(process)
+			sim.run()
+			self.assertEqual(seen, [ (0, 3), 4, (0, 4) ] + ([] if reset_less else [ 3 ]))
+
+	def test_comb_partition(self):
+		a   = Signal(8)
+		b   = Signal(8)
+		x   = Signal(8)
+		y   = Signal(8)
+		sel = Signal()
+		m   = Module()
+		m.d.comb += [ x.eq(a + 1), y.eq(b + 1) ]
+		with m.If(sel):
+			m.d.comb += [ x.eq(0), y.eq(1) ]
+		m.d.sync += a.eq(a)
+		seen = []
+
+		with patch.object(wasmrtl, 'WASMRunner', wraps = wasmrtl.WASMRunner) as runner:
+			sim = Simulator(m, engine = WASMSimEngine)
+		# Every process of the fragment shares a single module
+		self.assertEqual((runner.call_count, runner.exports.call_count), (0, 1))
+		state = sim._engine._state.memory
+
+		def process():
+			yield Settle()
+			for signal, value in ((a, 1), (b, 4), (sel, 1)):
+				runs = state.runs
+				yield signal.eq(value)
+				yield Settle()
+				seen.append((state.runs - runs, (yield x), (yield y)))
+
+		sim.add_process(process)
+		sim.run()
+		self.assertEqual(seen, [ (1, 2, 1), (1, 2, 5), (2, 0, 1) ])
+
+	def test_wait_until(self):
+		sim  = Simulator(self.m, engine = WASMSimEngine)
+		sim.add_clock(1e-6)
+		seen = []
+
+		def process():
+			seen.append((yield WaitUntil(self.counter == 5)))
+			seen.append((yield self.counter))
+			seen.append((yield WaitUntil(self.counter == 5)))
+			seen.append((yield WaitUntil(self.counter == 2, timeout = 3)))
+			seen.append((yield self.counter))
+			seen.append((yield WaitUntil(self.counter == 9, timeout = 0)))
+
+		sim.add_process(process)
+		sim.run()
+		self.assertEqual(seen, [ True, 5, True, False, 8, False ])
+
+	def test_wait_until_many(self):
+		flag  = Signal()
+		nflag = Signal()
+		m     = Module()
+		m.d.sync += flag.eq(~flag)
+		m.d.comb += nflag.eq(~flag)
+		seen  = []
+
+		def process():
+			for _ in range(1000):
+				seen.append((yield WaitUntil(flag)))
+				seen.append((yield WaitUntil(nflag)))
+			for _ in range(50):
+				seen.append((yield WaitUntil(flag == 1)))
+				seen.append((yield flag == 1))
+
+		with patch('torii_sim_wasm.WASMRunner', wraps = wasmrtl.WASMRunner) as runner:
+			sim = Simulator(m, engine = WASMSimEngine)
+			sim.add_clock(1e-6)
+			sim.add_process(process)
+			sim.run()
+
+		self.assertEqual(seen, [ True ] * 2000 + [ True, 1 ] * 50)
+		# Waiting on the same signal again finds the condition compiled for it before, as does
+		# building the same expression again, and every condition goes into the transient store
+		# rather than piling up in the main one
+		self.assertEqual(runner.call_count, 2 + 1 + 1)
+		self.assertTrue(all(call.kwargs.get('transient') for call in runner.call_args_list))
+
+	def test_wait_until_recycle(self):
+		sim  = Simulator(self.m, engine = WASMSimEngine)
+		sim.add_clock(1e-6)
+		seen = []
+
+		def waiter():
+			seen.append((yield WaitUntil(self.counter == 3000)))
+			seen.append((yield self.counter))
+
+		def reader():
+			# Enough commands to have the transient store replaced while the waiter is waiting
+			for offset in range(1100):
+				yield self.counter + offset
+			yield Delay(1e-6)
+
+		sim.add_process(waiter)
+		sim.add_process(reader)
+		sim.run()
+		self.assertEqual(seen, [ True, 3000 ])
+
+	def test_read_many(self):
+		a    = Signal(8, reset = 3)
+		b    = Signal(signed(8), reset = -2)
+		sim  = Simulator(self.m, engine = WASMSimEngine)
+		seen = []
+
+		def process():
+			seen.append((yield (a, b, a + 1, self.counter)))
+			seen.append((yield [ b, a ]))
+			seen.append((yield ()))
+
+		sim.add_process(process)
+		sim.run()
+		self.assertEqual(seen, [ (3, -2, 4, 0), [ -2, 3 ], () ])
+
+	def test_write_many(self):
+		a    = Signal(8)
+		b    = Signal(signed(8))
+		c    = Signal(4)
+		sim  = Simulator(self.m, engine = WASMSimEngine)
+		seen = []
+
+		def process():
+			yield [ a.eq(0x1ff), b.eq(-3), c.eq(a + 1) ]
+			yield Settle()
+			seen.append((yield (a, b, c)))
+			yield [ a.eq(7), b.eq(Const(-1, 4)) ]
+			yield Settle()
+			seen.append((yield (a, b, c)))
+			yield SignalDict(((a, 2), (b, -128), (c, 0x13)))
+			yield Settle()
+			seen.append((yield (a, b, c)))
+
+		sim.add_process(process)
+		sim.run()
+		self.assertEqual(seen, [ (0xff, -3, 1), (7, -1, 1), (2, -128, 3) ])
+
+	def test_ticks(self):
+		sim  = Simulator(self.m, engine = WASMSimEngine)
+		sim.add_clock(1e-6)
+		seen = []
+
+		def process():
+			yield Ticks(10)
+			seen.append((yield self.counter))
+			yield Ticks(1)
+			seen.append((yield self.counter))
+			yield Ticks(0)
+			seen.append((yield self.counter))
+			yield Ticks(1000)
+			seen.append((yield self.counter))
+
+		sim.add_process(process)
+		sim.run()
+		self.assertEqual(seen, [ 9, 10, 10, 1010 ])
+
+	def test_runner_cache(self):
+		seen = []
+
+		def process():
+			for offset in range(8):
+				seen.append((yield self.counter + offset))
+			seen.append((yield self.counter + 7))
+
+		with patch('torii_sim_wasm.RUNNER_CACHE_SIZE', 4):
+			for _ in range(2):
+				sim = Simulator(self.m, engine = WASMSimEngine)
+				sim.add_process(process)
+				sim.run()
+				self.assertEqual(len(sim._engine._state.runners), 4)
+
+		self.assertEqual(seen, [ *range(8), 7 ] * 2)
+
+	def test_memory(self):
+		a    = Signal(4, reset = 5)
+		b    = Signal(signed(12), reset = -2)
+		m    = Module()
+		m.d.comb += b.eq(a * 2)
+		sim  = Simulator(m, engine = WASMSimEngine)
+		slot = sim._engine.slot_map()
+		seen = []
+
+		def read(memory, signal):
+			entry = slot[signal]
+			value = int.from_bytes(memory[entry.curr_offset:entry.curr_offset + entry.size], 'little')
+			return value & ((1 << entry.width) - 1)
+
+		def process():
+			yield Settle()
+			memory = sim._engine.memory
+			seen.append((read(memory, a), read(memory, b)))
+
+			entry = slot[a]
+			memory[entry.next_offset] = 7
+			dirty = int.from_bytes(memory[entry.dirty_offset:entry.dirty_offset + 8], 'little')
+			memory[entry.dirty_offset:entry.dirty_offset + 8] = (dirty | entry.dirty_bit).to_bytes(8, 'little')
+			yield Settle()
+			seen.append(((yield a), (yield b)))
+
+		sim.add_process(process)
+		sim.run()
+		self.assertEqual((slot[a].width, slot[b].width, slot[b].size), (4, 12, 2))
+		self.assertEqual(seen, [ (5, 10), (7, 14) ])
+
+	def test_memory_bulk(self):
+		mem  = Memory(width = 8, depth = 16, init = range(16))
+		m    = Module()
+		m.submodules.rdport = rdport = mem.read_port(domain = 'comb')
+		sim  = Simulator(m, engine = WASMSimEngine)
+		seen = []
+
+		sim._engine.write_memory(mem, bytes(range(0xf0, 0xf4)), start = 2)
+		with self.assertRaises(ValueError):
+			sim._engine.write_memory(mem, b'\x00\x00', start = 15)
+
+		def process():
+			yield Settle()
+			seen.append(sim._engine.read_memory(mem, 0, 8))
+			yield rdport.addr.eq(3)
+			yield Settle()
+			seen.append((yield rdport.data))
+			sim._engine.write_memory(mem, [ 0x1ff, 0xaa ], start = 3)
+			yield Settle()
+			seen.append((yield rdport.data))
+			seen.append(sim._engine.read_memory(mem, 14))
+
+		sim.add_process(process)
+		sim.run()
+		self.assertEqual(seen, [ [ 0, 1, 0xf0, 0xf1, 0xf2, 0xf3, 6, 7 ], 0xf1, 0xff, [ 14, 15 ] ])
+
+	def test_memory_bulk_bytes(self):
+		wide = Memory(width = 16, depth = 4)
+		odd  = Memory(width = 20, depth = 2)
+		m    = Module()
+		m.submodules.wide = wide.read_port(domain = 'comb')
+		m.submodules.odd  = odd.read_port(domain = 'comb')
+		sim  = Simulator(m, engine = WASMSimEngine)
+		seen = []
+
+		sim._engine.write_memory(wide, bytes([ 0x34, 0x12, 0xcd, 0xab ]), start = 1)
+		sim._engine.write_memory(odd, bytearray([ 0x56, 0x34, 0xf2, 0x01, 0x00, 0x00 ]))
+		with self.assertRaises(ValueError):
+			sim._engine.write_memory(wide, b'\x00\x00\x00')
+
+		def process():
+			yield Settle()
+			seen.append(sim._engine.read_memory(wide))
+			seen.append(sim._engine.read_memory_bytes(wide, 1, 3))
+			seen.append(sim._engine.read_memory(odd))
+			seen.append(sim._engine.read_memory_bytes(odd))
+
+		sim.add_process(process)
+		sim.run()
+		self.assertEqual(seen, [
+			[ 0, 0x1234, 0xabcd, 0 ], b'\x34\x12\xcd\xab', [ 0x23456, 1 ], b'\x56\x34\x02\x01\x00\x00'
+		])
@@ -1,29 +1,84 @@
 # SPDX-License-Identifier: BSD-2-Clause
 
+from collections     import OrderedDict
 from collections.abc import Generator, Iterable
 from contextlib      import contextmanager
 from itertools       import chain
 from re              import search
-from typing          import IO
+from struct          import pack, unpack
+from typing          import IO, NamedTuple
 
 from vcd             import VCDWriter
 from vcd.gtkw        import GTKWSave
 from vcd.writer      import Variable
-from torii.hdl.ast   import Signal, SignalDict, Value
+from torii.hdl.ast   import Assign, Signal, SignalDict, Value, ValueKey
+from torii.hdl.cd    import ClockDomain
 from torii.hdl.ir    import Fragment
-from torii.sim._base import BaseEngine, BaseSignalState, BaseSimulation
+from torii.hdl.mem   import Memory
+from torii.sim._base import BaseEngine, BaseSimulation
 
-from ._wasm_engine   import WASMConfig, WASMInstance, WASMValue, __version__
+from ._wasm_engine   import WASMConfig, WASMInstance, WASMRunner, __version__
 from .wasmrtl        import WASMFragmentCompiler
-from .wasmclock      import WASMClockProcess
-from .wasmcoro       import WASMCoroProcess
+from .wasmcoro       import Ticks, WASMCoroProcess, WaitUntil
 
 __all__ = (
+	'Ticks',
+	'WASMConfig',
 	'WASMSimEngine',
+	'WASMSlot',
+	'WaitUntil',
 )
 
 __version__ = __version__
 
+# Number of runners for the commands of coroutine processes to keep around for each simulation
+RUNNER_CACHE_SIZE = 1024
+
+# struct formats for the word sizes that have one
+_WORD_FORMATS = { 1: 'B', 2: 'H', 4: 'I', 8: 'Q' }
+
+def _word_size(memory: Memory) -> int:
+	# Bytes each word of the memory takes up when packed into bytes
+	return max((memory.width + 7) // 8, 1)
+
+def _unpack_words(data: bytes | bytearray | memoryview, size: int) -> list[int]:
+	data = memoryview(data).cast('B')
+	if len(data) % size != 0:
+		raise ValueError(f'Length of the data, {len(data)} bytes, is not a multiple of the word size of {size} bytes')
+
+	count = len(data) // size
+	if size in _WORD_FORMATS:
+		return list(unpack(f'<{count}{_WORD_FORMATS[size]}', data))
+	return [ int.from_bytes(data[offset:offset + size], 'little') for offset in range(0, len(data), size) ]
+
+def _pack_words(words: list[int], size: int) -> bytes:
+	if size in _WORD_FORMATS:
+		return pack(f'<{len(words)}{_WORD_FORMATS[size]}', *words)
+	return b''.join(word.to_bytes(size, 'little') for word in words)
+
+def _runner_key(obj: object) -> object:
+	# Values and assignments are compared structurally, along with the shape as `ValueKey` doesn't
+	# tell apart constants that only differ in signedness
+	if isinstance(obj, Value):
+		shape = obj.shape()
+		return (ValueKey(obj), shape.width, shape.signed)
+	if isinstance(obj, Assign):
+		return (_runner_key(obj.lhs), _runner_key(obj.rhs))
+	return id(obj)
+
+class WASMSlot(NamedTuple):
+	'''
+	Where the state of a signal lives in the linear memory of the simulation. Values are stored
+	little endian in ``size`` bytes, and need to be masked down to ``width`` bits.
+	'''
+
+	curr_offset:  int
+	next_offset:  int
+	dirty_offset: int
+	dirty_bit:    int
+	size:         int
+	width:        int
+
 class _VCDWriter:
 	@staticmethod
 	def decode_to_vcd(signal, value):
@@ -159,210 +214,280 @@ class _VCDWriter:
 		if self._close_gtkw:
 			self.gtkw_file.close()
 
-class _Timeline:
-	def __init__(self) -> None:
-		self.now = 0
-		self.deadlines = dict()
-
-	def reset(self):
-		self.now = 0
-		self.deadlines.clear()
-
-	def at(self, run_at, process):
-		if process in self.deadlines:
-			raise ValueError(f'Process {process!r} already in deadline list')
-		self.deadlines[process] = run_at
-
-	def delay(self, delay_by, process):
-		if delay_by is None:
-			run_at = self.now
-		else:
-			run_at = self.now + delay_by
-		self.at(run_at, process)
-
-	def advance(self):
-		nearest_processes = set()
-		nearest_deadline = None
-		for process, deadline in self.deadlines.items():
-			if deadline is None:
-				if nearest_deadline is not None:
-					nearest_processes.clear()
-				nearest_processes.add(process)
-				nearest_deadline = self.now
-				break
-			elif nearest_deadline is None or deadline <= nearest_deadline:
-				if deadline < self.now:
-					raise ValueError(f'Deadline of {deadline} is behind our current state of {self.now}')
-
-				if nearest_deadline is not None and deadline < nearest_deadline:
-					nearest_processes.clear()
-				nearest_processes.add(process)
-				nearest_deadline = deadline
-
-		if not nearest_processes:
-			return False
-
-		for process in nearest_processes:
-			process.runnable = True
-			del self.deadlines[process]
-		self.now = nearest_deadline
-
-		return True
-
-class _WASMGlobal():
-	def __init__(self, memory: WASMInstance, signal, offset, value) -> None:
-		self._memory = memory
-		self._signal = signal
-		self._wasm   = WASMValue(memory, len(self._signal), offset, value)
-		self._value  = value
-		self.set(value)
-
-	def set(self, value):
-		self._value = value & ((1 << len(self._signal)) - 1)
-		self._wasm.set(value)
-
-	def get(self):
-		self._wasm.get()
-
-	def value(self):
-		return self._value
-
-	def update(self, value):
-		self._value = value
-
-	def __eq__(self, other):
-		if isinstance(other, _WASMGlobal):
-			return self.value() == other.value()
-		else:
-			return self.value() == int(other)
-
-class _WASMSignalState(BaseSignalState):
-	__slots__ = ('signal', 'curr', 'next', 'waiters', 'pending')
-
-	def __init__(self, memory: WASMInstance, index, signal, pending) -> None:
-		self.signal = signal
-		self.pending = pending
-		self.waiters = dict()
-		self.curr = _WASMGlobal(memory, signal, index * 2, signal.reset)
-		self.next = _WASMGlobal(memory, signal, index * 2 + 1, signal.reset)
-
-	def set(self, value):
-		self.next.update(value)
-		self.pending.add(self)
-
-	def update(self, value):
-		raw_val = int(value)
-		if self.next.value() == raw_val:
-			return
-
-		self.next.set(raw_val)
-		self.pending.add(self)
-
-	def commit(self):
-		if self.curr == self.next:
-			return False
-		self.curr.set(self.next.value())
-
-		awoken_any = False
-		for process, trigger in self.waiters.items():
-			if trigger is None or trigger == self.curr.value():
-				process.runnable = awoken_any = True
-		return awoken_any
-
 class _WASMimulation(BaseSimulation):
 	def __init__(self, config: WASMConfig | None = None) -> None:
-		self.timeline = _Timeline()
-		self.signals  = SignalDict()
-		self.slots    = []
-		self.pending  = set()
+		self.signals   = SignalDict()
+		# The signal for every slot, the widths and values of the slots live in the native instance
+		self.slots     = []
+		self.processes = []
+		# Number of non-passive processes, maintained by the processes themselves
+		self.active    = 0
 		self.config = WASMConfig() if config is None else config
 		self.memory = WASMInstance(config = self.config)
-
-	def set_slot(self, index, value):
-		self.slots[index].set(value)
+		self.memory64 = self.memory.memory64
+		# Runners for the commands of coroutine processes, least recently used first. Each one is
+		# keyed by the structure of the values and assignments it was compiled from, so building
+		# the same expression again finds it, and by the identity of anything else, which is kept
+		# alive along with it so the key stays unique. They all go in the transient store, so
+		# neither the cache nor the store keeps growing however many different commands are run.
+		self.runners = OrderedDict()
+		self.memories = {}
+
+	def get_runner(self, kind, objects, compile):
+		key = (kind, *map(_runner_key, objects))
+		if key in self.runners:
+			self.runners.move_to_end(key)
+			return self.runners[key][1]
+
+		runner = WASMRunner(compile(), self.memory, transient = True)
+		self.runners[key] = (objects, runner)
+		if len(self.runners) > RUNNER_CACHE_SIZE:
+			self.runners.popitem(last = False)
+		return runner
+
+	def wake(self, process):
+		self.memory.wake(process.pid)
+
+	def add_process(self, process, runner = None):
+		# Processes with a runner are run natively, everything else gets handed back to us by `settle`
+		process.pid = self.memory.add_process(runner)
+		self.processes.append(process)
+		# Processes come out of `reset()` already flagged as runnable, so queue them up directly
+		if process.runnable:
+			self.wake(process)
+
+	def memory_slots(self, memory):
+		# The slot of every word of the memory, looked up once and kept along with the memory so
+		# the key stays unique
+		try:
+			return self.memories[id(memory)][1]
+		except KeyError:
+			slots = [ self.get_signal(memory[addr]) for addr in range(memory.depth) ]
+			self.memories[id(memory)] = (memory, slots)
+			return slots
 
 	def get_signal(self, signal):
 		try:
 			return self.signals[signal]
 		except KeyError:
-			index = len(self.slots)
-			self.slots.append(_WASMSignalState(self.memory, index, signal, self.pending))
+			index = self.memory.add_slot(len(signal), signal.reset)
+			self.slots.append(signal)
 			self.signals[signal] = index
 			return index
 
-	def commit(self, changed = None):
-		converged = True
-		for signal_state in self.pending:
-			if signal_state.commit():
-				converged = False
-		if changed is not None:
-			changed.update(self.pending)
-		self.pending.clear()
-		return converged
+	# The layout of the slots is up to the native slot table, narrow slots are packed together
+	def curr_offset(self, index):
+		return self.memory.curr_offset(index)
+
+	def next_offset(self, index):
+		return self.memory.next_offset(index)
+
+	def dirty_offset(self, index):
+		return self.memory.dirty_offset(index)
+
+	def dirty_bit(self, index):
+		return self.memory.dirty_bit(index)
+
+	def slot_size(self, index):
+		return self.memory.slot_size(index)
+
+	def settle(self):
+		return [ self.processes[pid] for pid in self.memory.settle() ]
 
 	def wait_interval(self, process, interval):
-		self.timeline.delay(interval, process)
+		self.memory.wait_interval(process.pid, interval)
+
+	def add_fanout(self, process, signal, *, trigger = None):
+		self.memory.add_fanout(process.pid, self.get_signal(signal), trigger)
+
+	def add_input(self, process, signal):
+		self.memory.add_input(process.pid, self.get_signal(signal))
+
+	def set_enable(self, process, signal, *, reset = None):
+		self.memory.set_enable(
+			process.pid, self.get_signal(signal), None if reset is None else self.get_signal(reset)
+		)
+
+	def wait_until(self, process, runner, *, timeout = None):
+		self.memory.wait_until(process.pid, runner, timeout)
+
+	def wait_count(self, process, count):
+		self.memory.wait_count(process.pid, count)
 
 	def add_trigger(self, process, signal, *, trigger = None):
-		index = self.get_signal(signal)
-		if process in self.slots[index].waiters and self.slots[index].waiters[process] != trigger:
-			raise ValueError('Unable to add trigger for process!')
-		self.slots[index].waiters[process] = trigger
+		self.memory.add_trigger(process.pid, self.get_signal(signal), trigger)
 
 	def remove_trigger(self, process, signal):
-		index = self.get_signal(signal)
-		if process not in self.slots[index].waiters:
-			raise ValueError(f'Unable to remove trigger for process {process!r}, not in the slot list')
-		del self.slots[index].waiters[process]
+		self.memory.remove_trigger(process.pid, self.get_signal(signal))
 
 class WASMSimEngine(BaseEngine):
+	# Configuration of the wasm runtime, the defaults if None, see `with_config`
+	config: WASMConfig | None = None
+
 	def __init__(self, fragment: Fragment) -> None:
-		self._config = WASMConfig()
+		self._config = WASMConfig() if self.config is None else self.config
 		self._state = _WASMimulation(config = self._config)
-		self._timeline = self._state.timeline
 		self._frag = fragment
 		self._processes = WASMFragmentCompiler(self._state)(self._frag)
 		self._vcd_writers = []
 
+	@classmethod
+	def with_config(cls, config: WASMConfig) -> type['WASMSimEngine']:
+		'''
+		Engine to pass to the ``Simulator`` in place of ``WASMSimEngine``, that runs the simulation
+		with the given configuration of the wasm runtime.
+		'''
+
+		return type(cls.__name__, (cls,), { 'config': config })
+
 	def add_coroutine_process(self, process, *, default_cmd):
-		self._processes.add(
-			WASMCoroProcess(self._state, self._frag.domains, process, default_cmd = default_cmd)
-		)
+		coro_process = WASMCoroProcess(self._state, self._frag.domains, process, default_cmd = default_cmd)
+		self._processes.add(coro_process)
+		self._state.add_process(coro_process)
 
 	def add_clock_process(self, clock, *, phase, period):
-		self._processes.add(
-			WASMClockProcess(self._state, clock, phase = phase, period = period)
-		)
+		if len(clock) != 1:
+			raise TypeError(f'Clock signal must be exactly 1-wide, not {len(clock)}')
+
+		# Clocks are toggled by the native timeline directly, there is no process behind them
+		self._state.memory.add_clock(self._state.get_signal(clock), phase, period // 2)
 
 	def reset(self):
 		pass
 
 	def _step(self):
-		changed = set() if self._vcd_writers else None
-		# Performs the two phases of a delta cycle in a loop:
-		converged = False
-		while not converged:
-			# 1. eval: run and suspend every non-waiting process once, queueing signal changes
-			for process in self._processes:
-				if process.runnable:
-					process.runnable = False
-					process.run()
-
-			# 2. commit: apply every queued signal change, waking up any waiting processes
-			converged = self._state.commit(changed)
-
-		for vcd_writer in self._vcd_writers:
-			for signal_state in changed:
-				vcd_writer.update(self._timeline.now, signal_state.signal, signal_state.curr.value())
+		# The delta cycles are run natively until the design converges, we only get control back
+		# when a process that has to run in Python was woken up in the eval phase.
+		while processes := self._state.settle():
+			for process in processes:
+				process.run()
+
+		if self._vcd_writers:
+			for index in self._state.memory.take_changed():
+				signal = self._state.slots[index]
+				value  = self._state.memory.get(index)
+				for vcd_writer in self._vcd_writers:
+					vcd_writer.update(self.now, signal, value)
 
 	def advance(self):
 		self._step()
-		self._timeline.advance()
-		return any(not process.passive for process in self._processes)
+		self._state.memory.advance()
+		return self._state.active > 0
 
 	@property
 	def now(self):
-		return self._timeline.now
+		return self._state.memory.now
+
+	@property
+	def memory(self) -> memoryview:
+		'''
+		Writable view of the linear memory holding the state of every signal, see ``slot_map`` for
+		where each one lives. The view only covers the memory in use when it was taken.
+
+		Writing to the current value of a signal changes it without waking anything up. To have
+		a write take effect like any other, write the next value and set the signal's bit in its
+		dirty word instead, so it gets committed by the next step.
+		'''
+
+		return memoryview(self._state.memory)
+
+	def slot_map(self) -> SignalDict[WASMSlot]:
+		'''
+		Where the state of every signal in the simulation lives in ``memory``.
+		'''
+
+		state = self._state
+		return SignalDict(
+			(signal, WASMSlot(
+				state.curr_offset(index), state.next_offset(index), state.dirty_offset(index),
+				state.dirty_bit(index), state.slot_size(index), len(signal)
+			)) for index, signal in enumerate(state.slots)
+		)
+
+	@property
+	def fast_forward(self) -> bool:
+		'''
+		Whether to skip over stretches of time where only the clocks are changing, straight to the
+		next deadline of a coroutine process. This is off by default, and never done while writing
+		waveforms.
+
+		The engine doesn't know the deadline passed to ``run_until``, so a single step may skip
+		well past it, up to the next deadline of a coroutine process. Only turn this on for
+		simulations that are run to completion, or with ``run_cycles``.
+		'''
+
+		return self._state.memory.fast_forward
+
+	@fast_forward.setter
+	def fast_forward(self, fast_forward: bool) -> None:
+		self._state.memory.fast_forward = fast_forward
+
+	def run_cycles(self, cycles: int, domain: str | ClockDomain = 'sync') -> None:
+		'''
+		Run the simulation for ``cycles`` active edges of the clock of ``domain``.
+
+		The time in between is spent entirely in the native engine, only returning to Python to run
+		any coroutine processes that wake up. The clock of the domain must have been added with
+		``add_clock``.
+		'''
+
+		if not isinstance(domain, ClockDomain):
+			domain = self._frag.domains[domain]
+		slot    = self._state.get_signal(domain.clk)
+		trigger = 1 if domain.clk_edge == 'pos' else 0
+
+		self._step()
+		while cycles > 0:
+			cycles -= self._state.memory.run_cycles(slot, trigger, cycles)
+			# Run any coroutine processes that woke up, and write out the changes if tracing
+			self._step()
+			if self._state.memory.deadline is None:
+				break
+
+	def read_memory(self, memory: Memory, start: int = 0, stop: int | None = None) -> list[int]:
+		'''
+		Read the current contents of ``memory`` from ``start`` up to ``stop``, in a single native
+		call. The words are returned as unsigned integers, so they can be turned into an ``array``
+		or a NumPy array as needed, see ``read_memory_bytes`` for getting them as ``bytes``.
+		'''
+
+		state = self._state
+		return state.memory.get_many(state.memory_slots(memory)[start:stop])
+
+	def read_memory_bytes(self, memory: Memory, start: int = 0, stop: int | None = None) -> bytes:
+		'''
+		Read the current contents of ``memory`` from ``start`` up to ``stop`` as ``bytes``, with
+		each word packed little endian into as many bytes as it takes to hold the width of the
+		memory, the same layout ``write_memory`` takes ``bytes`` in.
+		'''
+
+		return _pack_words(self.read_memory(memory, start, stop), _word_size(memory))
+
+	def write_memory(self, memory: Memory, data: Iterable[int] | bytes, start: int = 0) -> None:
+		'''
+		Write ``data`` into ``memory`` starting from ``start``, in a single native call. The data
+		can be an ``array``, a NumPy array or any other iterable of integers, one per word, which
+		get truncated to the width of the memory.
+
+		``bytes``, ``bytearray`` and byte ``memoryview`` data is taken as words packed little endian
+		into as many bytes as it takes to hold the width of the memory, one byte per word for
+		8-bit wide memories, two for 16-bit wide ones and so on.
+
+		The writes are queued up like any other write from a process, and take effect on the
+		next step of the simulation.
+		'''
+
+		if isinstance(data, (bytes, bytearray, memoryview)):
+			data = _unpack_words(data, _word_size(memory))
+		else:
+			data = list(data)
+		if start < 0 or start + len(data) > memory.depth:
+			raise ValueError(
+				f'Writing {len(data)} words at {start} is out of bounds for a memory of depth {memory.depth}'
+			)
+
+		state = self._state
+		state.memory.set_next_many(state.memory_slots(memory)[start:start + len(data)], data)
 
 	@contextmanager
 	def write_vcd(
@@ -372,7 +497,9 @@ class WASMSimEngine(BaseEngine):
 		vcd_writer = _VCDWriter(self._frag, vcd_file = vcd_file, gtkw_file = gtkw_file, traces = traces)
 		try:
 			self._vcd_writers.append(vcd_writer)
+			self._state.memory.tracing = True
 			yield
 		finally:
-			vcd_writer.close(self._timeline.now)
+			vcd_writer.close(self.now)
 			self._vcd_writers.remove(vcd_writer)
+			self._state.memory.tracing = bool(self._vcd_writers)
@@ -1,10 +1,14 @@
 # SPDX-License-Identifier: BSD-2-Clause
 
-from enum import Enum
-from pathlib import Path
+from collections.abc import Sequence
+from enum            import Enum
+from pathlib         import Path
 
 __version__: str
 
+MAX_PAGES: int
+MAX_PAGES64: int
+
 class Backend(Enum):
 	WINCH = ...
 	CRANELIFT = ...
@@ -23,27 +27,127 @@ class WASMConfig:
 	def __init__(
 		self, backend: Backend = Backend.WINCH, opt_level: OptLevel = OptLevel.SPEED,
 		profiler: Profiler = Profiler.NONE, max_stack: int = 524288, coredump_on_trap: bool = False,
-		inlining: bool = False, cache_path: Path | None = None
+		inlining: bool = False, cache_path: Path | None = None, memory64: bool = False
 	) -> None:
 		...
 
 class WASMInstance():
+	tracing: bool
+	fast_forward: bool
+
+	@property
+	def memory64(self) -> bool:
+		...
+
+	@property
+	def runs(self) -> int:
+		...
+
+	@property
+	def now(self) -> int:
+		...
+
+	@property
+	def deadline(self) -> int | None:
+		...
+
 	def __init__(self, config: WASMConfig | None = None) -> None:
 		...
 
-class WASMValue():
-	def __init__(self, instance: WASMInstance, length: int, offset: int, value: int) -> None:
+	def add_slot(self, width: int, reset: int) -> int:
+		...
+
+	def curr_offset(self, slot: int) -> int:
+		...
+
+	def next_offset(self, slot: int) -> int:
+		...
+
+	def dirty_offset(self, slot: int) -> int:
+		...
+
+	def dirty_bit(self, slot: int) -> int:
+		...
+
+	def slot_size(self, slot: int) -> int:
+		...
+
+	def add_process(self, runner: WASMRunner | None = None) -> int:
+		...
+
+	def wake(self, process: int) -> None:
+		...
+
+	def add_fanout(self, process: int, slot: int, trigger: int | None = None) -> None:
+		...
+
+	def add_input(self, process: int, slot: int) -> None:
+		...
+
+	def set_enable(self, process: int, slot: int, reset: int | None = None) -> None:
+		...
+
+	def wait_until(self, process: int, runner: WASMRunner, timeout: int | None = None) -> None:
 		...
 
-	def set(self, value: int) -> None:
+	def wait_count(self, process: int, count: int) -> None:
 		...
 
-	def get(self) -> int:
+	def add_trigger(self, process: int, slot: int, trigger: int | None = None) -> None:
+		...
+
+	def remove_trigger(self, process: int, slot: int) -> None:
+		...
+
+	def wait_interval(self, process: int, interval: int | None = None) -> None:
+		...
+
+	def add_clock(self, slot: int, phase: int, half_period: int) -> None:
+		...
+
+	def advance(self) -> bool:
+		...
+
+	def set_next(self, slot: int, value: int) -> None:
+		...
+
+	def get(self, slot: int) -> int:
+		...
+
+	def get_many(self, slots: Sequence[int]) -> list[int]:
+		...
+
+	def set_next_many(self, slots: Sequence[int], values: Sequence[int]) -> None:
+		...
+
+	def run(self, processes: Sequence[int]) -> None:
+		...
+
+	def settle(self) -> list[int]:
+		...
+
+	def run_cycles(self, slot: int, trigger: int, cycles: int) -> int:
+		...
+
+	def take_changed(self) -> list[int]:
+		...
+
+	def __buffer__(self, flags: int) -> memoryview:
+		...
+
+	def __release_buffer__(self, buffer: memoryview) -> None:
 		...
 
 class WASMRunner():
-	def __init__(self, src: str, instance: WASMInstance, callback) -> None:
+	def __init__(self, src: str, instance: WASMInstance, transient: bool = False) -> None:
+		...
+
+	@staticmethod
+	def exports(src: str, instance: WASMInstance, names: Sequence[str]) -> list[WASMRunner]:
 		...
 
 	def __call__(self) -> int:
 		...
+
+	def values(self, params: Sequence[int] = ()) -> list[int]:
+		...
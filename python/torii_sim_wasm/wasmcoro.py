@@ -1,21 +1,74 @@
 # SPDX-License-Identifier: BSD-2-Clause
 
+from collections.abc import Mapping
 from inspect         import getfile, getlineno, iscoroutine, isgenerator
 
-from torii.hdl       import ClockDomain, Const, Value
-from torii.hdl.ast   import SignalSet, Statement, ValueCastable
+from torii.hdl       import ClockDomain, Const, Signal, Value
+from torii.hdl.ast   import Assign, SignalDict, Statement, ValueCastable
 from torii.sim._base import BaseProcess
-from torii.sim.core  import Active, Delay, Passive, Settle, Tick
+from torii.sim.core  import Active, Command, Delay, Passive, Settle, Tick
 from .wasmrtl        import _RHSValueCompiler, _StatementCompiler
-from ._wasm_engine   import WASMRunner
 
 __all__ = (
+	'Ticks',
 	'WASMCoroProcess',
+	'WaitUntil',
 )
 
 def foo(one, two):
 	assert False
 
+def _is_const_write(stmt):
+	return isinstance(stmt, Assign) and isinstance(stmt.lhs, Signal) and isinstance(stmt.rhs, Const)
+
+class Ticks(Command):
+	'''
+		Waits for ``count`` active edges of the clock of ``domain``, the same as yielding
+		``Tick(domain)`` that many times, but the edges are counted natively and the process is
+		only woken up after the last one.
+	'''
+	def __init__(self, count: int, domain: str | ClockDomain = 'sync') -> None:
+		if not isinstance(domain, (str, ClockDomain)):
+			raise TypeError(f'Domain must be a string or a ClockDomain instance, not {domain!r}')
+		if domain == 'comb':
+			raise ValueError('Unable to tick the combinatorial domain!')
+		if count < 0:
+			raise ValueError(f'Tick count must be a non-negative number of cycles, not {count!r}')
+
+		self.count  = count
+		self.domain = domain
+
+	def __repr__(self) -> str:
+		return f'(ticks {self.count} {self.domain})'
+
+class WaitUntil(Command):
+	'''
+		Waits for active edges of the clock of ``domain`` until ``condition`` is true, the same
+		as ``while not (yield condition): yield Tick(domain)``, but the condition is evaluated
+		natively and the process isn't woken up until it holds.
+
+		If ``timeout`` is given, at most that many edges are waited for. The response is whether
+		the condition is true.
+	'''
+	def __init__(
+		self, condition: Value | ValueCastable, domain: str | ClockDomain = 'sync', *,
+		timeout: int | None = None
+	) -> None:
+		if not isinstance(domain, (str, ClockDomain)):
+			raise TypeError(f'Domain must be a string or a ClockDomain instance, not {domain!r}')
+		if domain == 'comb':
+			raise ValueError('Unable to wait on the combinatorial domain!')
+		if timeout is not None and timeout < 0:
+			raise ValueError(f'Timeout must be a non-negative number of cycles, not {timeout!r}')
+
+		# Kept as given, so waiting on the same signal again finds the same compiled condition
+		self.condition = Value.cast(condition)
+		self.domain    = domain
+		self.timeout   = timeout
+
+	def __repr__(self) -> str:
+		return f'(wait-until {self.condition!r} {self.domain})'
+
 class WASMCoroProcess(BaseProcess):
 	def __init__(self, state, domains, constructor, *, default_cmd = None) -> None:
 		self.state = state
@@ -23,14 +76,30 @@ class WASMCoroProcess(BaseProcess):
 		self.constructor = constructor
 		self.default_cmd = default_cmd
 
+		self._passive = True
 		self.reset()
 
+	@property
+	def passive(self):
+		return self._passive
+
+	@passive.setter
+	def passive(self, value):
+		# Keep the simulation-wide active process count in step so the engine never has to scan for it
+		if value != self._passive:
+			self.state.active += -1 if value else 1
+			self._passive = value
+
 	def reset(self):
 		self.runnable = True
 		self.passive = False
 
 		self.coroutine = self.constructor()
-		self.waits_on = SignalSet()
+		# Triggers registered with the engine, and the ones the current wait needs
+		self.waits_on = SignalDict()
+		self.triggers = SignalDict()
+		# Condition of the `WaitUntil` the process is suspended on, it is the response once resumed
+		self.waits_until = None
 
 	def src_loc(self):
 		coroutine = self.coroutine
@@ -44,23 +113,63 @@ class WASMCoroProcess(BaseProcess):
 			frame = coroutine.cr_frame
 		return f'{getfile(frame)}:{getlineno(frame)}'
 
+	def get_domain(self, command):
+		domain = command.domain
+		if isinstance(domain, ClockDomain):
+			return domain
+		elif domain in self.domains:
+			return self.domains[domain]
+		else:
+			raise NameError(
+				f'Received command {command!r} that refers to a nonexistent '
+				f'domain {command.domain!r} from process {self.src_loc()!r}'
+			)
+
+	def add_clock_triggers(self, domain):
+		self.add_trigger(domain.clk, trigger = 1 if domain.clk_edge == 'pos' else 0)
+		if domain.rst is not None and domain.async_reset:
+			self.add_trigger(domain.rst, trigger = 1)
+
 	def add_trigger(self, signal, trigger = None):
-		self.state.add_trigger(self, signal, trigger = trigger)
-		self.waits_on.add(signal)
+		self.triggers[signal] = trigger
 
-	def clear_triggers(self):
-		for signal in self.waits_on:
-			self.state.remove_trigger(self, signal)
-		self.waits_on.clear()
+	def update_triggers(self):
+		# Only the triggers that differ from the ones of the last wait are touched, so a process
+		# waiting on the same clock edge every time keeps its subscription
+		for signal, trigger in list(self.waits_on.items()):
+			if signal not in self.triggers or self.triggers[signal] != trigger:
+				self.state.remove_trigger(self, signal)
+				del self.waits_on[signal]
+		for signal, trigger in self.triggers.items():
+			if signal not in self.waits_on:
+				self.state.add_trigger(self, signal, trigger = trigger)
+				self.waits_on[signal] = trigger
+		self.triggers.clear()
+
+	def write(self, signals, values):
+		signals = tuple(signals)
+		runner = self.state.get_runner(
+			'write', signals, lambda: _StatementCompiler.compile_writes(self.state, signals)
+		)
+		runner.values([ value & ((1 << len(signal)) - 1) for signal, value in zip(signals, values) ])
 
 	def run(self):
 		if self.coroutine is None:
 			return
 
-		self.clear_triggers()
+		try:
+			self.resume()
+		finally:
+			self.update_triggers()
 
+	def resume(self):
 		response = None
 		exception = None
+		if self.waits_until is not None:
+			# We only get woken up once the condition holds, or the wait timed out
+			response = bool(self.waits_until())
+			self.waits_until = None
+
 		while True:
 			try:
 				if exception is None:
@@ -81,33 +190,76 @@ class WASMCoroProcess(BaseProcess):
 				if isinstance(command, ValueCastable):
 					command = Value.cast(command)
 				if isinstance(command, Value):
-					if not hasattr(command, 'runner'):
-						module_code = _RHSValueCompiler.compile(self.state, command, mode = 'curr')
-						command.runner = WASMRunner(module_code, self.state.memory, self.state.set_slot)
-
-					result = command.runner()
+					runner = self.state.get_runner(
+						'read', (command,), lambda: _RHSValueCompiler.compile(self.state, command, mode = 'curr')
+					)
+					result = runner()
 					response = Const.normalize(result, command.shape())
 
-				elif isinstance(command, Statement):
-					if not hasattr(command, 'runner'):
-						module_code = _StatementCompiler.compile(self.state, command)
-						command.runner = WASMRunner(module_code, self.state.memory, self.state.set_slot)
-					command.runner()
+				elif isinstance(command, Mapping):
+					self.write(command.keys(), [ Const.cast(value).value for value in command.values() ])
 
-				elif type(command) is Tick:
-					domain = command.domain
-					if isinstance(domain, ClockDomain):
-						pass
-					elif domain in self.domains:
-						domain = self.domains[domain]
+				elif isinstance(command, Statement) and _is_const_write(command):
+					# Writes of constants to signals only need one module per signal, not per value
+					self.write((command.lhs,), (command.rhs.value,))
+
+				elif isinstance(command, (tuple, list)) and command and all(isinstance(stmt, Statement) for stmt in command):
+					if all(_is_const_write(stmt) for stmt in command):
+						self.write([ stmt.lhs for stmt in command ], [ stmt.rhs.value for stmt in command ])
 					else:
-						raise NameError(
-							f'Received command {command!r} that refers to a nonexistent '
-							f'domain {command.domain!r} from process {self.src_loc()!r}'
+						stmts = tuple(command)
+						runner = self.state.get_runner(
+							'exec', stmts, lambda: _StatementCompiler.compile(self.state, list(stmts))
 						)
-					self.add_trigger(domain.clk, trigger = 1 if domain.clk_edge == 'pos' else 0)
-					if domain.rst is not None and domain.async_reset:
-						self.add_trigger(domain.rst, trigger = 1)
+						runner()
+
+				elif isinstance(command, (tuple, list)):
+					values = tuple(Value.cast(value) for value in command)
+					runner = self.state.get_runner(
+						'read', values, lambda: _RHSValueCompiler.compile_many(self.state, values, mode = 'curr')
+					)
+					results = runner.values() if values else ()
+					response = type(command)(
+						Const.normalize(result, value.shape()) for result, value in zip(results, values)
+					)
+
+				elif isinstance(command, Statement):
+					runner = self.state.get_runner(
+						'exec', (command,), lambda: _StatementCompiler.compile(self.state, command)
+					)
+					runner()
+
+				elif type(command) is Tick:
+					self.add_clock_triggers(self.get_domain(command))
+					return
+
+				elif type(command) is Ticks:
+					domain = self.get_domain(command)
+					if command.count == 0:
+						continue
+
+					self.add_clock_triggers(domain)
+					if command.count > 1:
+						self.state.wait_count(self, command.count)
+					return
+
+				elif type(command) is WaitUntil:
+					domain = self.get_domain(command)
+					# The condition is evaluated natively in the transient store, which moves any
+					# conditions still being waited on over when it gets replaced
+					runner = self.state.get_runner(
+						'until', (command.condition,),
+						lambda: _RHSValueCompiler.compile(self.state, command.condition.bool(), mode = 'curr')
+					)
+
+					# The condition is checked before the first edge, same as the loop it replaces
+					response = bool(runner())
+					if response or command.timeout == 0:
+						continue
+
+					self.add_clock_triggers(domain)
+					self.state.wait_until(self, runner, timeout = command.timeout)
+					self.waits_until = runner
 					return
 
 				elif type(command) is Settle:
@@ -1,33 +1,37 @@
 # SPDX-License-Identifier: BSD-2-Clause
 
+from collections import OrderedDict
 from contextlib  import contextmanager
 from os          import getenv
 from tempfile    import NamedTemporaryFile
 
-from torii.hdl.ast   import SignalSet
+from torii.hdl.ast   import Assign, Const, Signal, SignalSet, Switch
 from torii.hdl.ir    import Fragment
-from torii.hdl.xfrm  import LHSGroupFilter, StatementVisitor, ValueVisitor
+from torii.hdl.xfrm  import LHSGroupAnalyzer, LHSGroupFilter, StatementVisitor, ValueVisitor
 from torii.sim._base import BaseProcess
+from torii.util      import flatten, union
 
-from ._wasm_engine   import WASMRunner
+from ._wasm_engine   import MAX_PAGES, MAX_PAGES64, WASMRunner
 
 __all__ = (
 	'WASMFragmentCompiler',
 	'WASMRTLProcess',
 )
 
+# Load and store instructions for every slot storage size in bytes, narrow slots are zero extended
+WASM_SLOT_LOAD  = { 1: 'i64.load8_u', 2: 'i64.load16_u', 4: 'i64.load32_u', 8: 'i64.load' }
+WASM_SLOT_STORE = { 1: 'i64.store8',  2: 'i64.store16',  4: 'i64.store32',  8: 'i64.store' }
+
+# Stores the next value of a slot, and if it changed sets the slot's bit in the dirty bitmap so the
+# commit knows to look at it. The offsets and bit are worked out when generating the call, there is
+# one of these for every slot storage size.
 WASM_SET_SLOT = '''
-	(func $slots_set (param $index i64) (param $value i64)
-		(local $curr i64)
-		(local $next i64)
-		(local $next_off i64)
-		(local.set $curr (i64.load (i64.mul (local.get $index) (i64.const 16))))
-		(local.set $next_off (i64.mul (i64.add (i64.mul (local.get $index) (i64.const 2)) (i64.const 1)) (i64.const 8)))
-		(local.set $next (i64.load (local.get $next_off)))
-		(if (i64.ne (local.get $next) (local.get $value))
+	(func $slots_set{size} (param $next_off {addr}) (param $dirty_off {addr}) (param $bit i64) (param $value i64)
+		(local.set $value (i64.and (local.get $value) (i64.const {mask:#x})))
+		(if (i64.ne ({load} (local.get $next_off)) (local.get $value))
 			(then
-				(i64.store (local.get $next_off) (local.get $value))
-				(call $slots_set_py (local.get $index) (local.get $value))
+				({store} (local.get $next_off) (local.get $value))
+				(i64.store (local.get $dirty_off) (i64.or (i64.load (local.get $dirty_off)) (local.get $bit)))
 			)
 		)
 	)
@@ -82,7 +86,7 @@ WASM_ZMOD = '''
 '''
 
 class WASMRTLProcess(BaseProcess):
-	__slots__ = ('is_comb', 'runnable', 'passive', 'run')
+	__slots__ = ('is_comb', 'runnable', 'passive', 'pid')
 
 	def __init__(self, *, is_comb) -> None:
 		self.is_comb  = is_comb
@@ -94,13 +98,19 @@ class WASMRTLProcess(BaseProcess):
 		self.passive  = True
 
 class _WASMEmitter:
-	def __init__(self):
+	def __init__(self, *, memory64 = False):
+		# Address type of the linear memory, 32-bit memories are what get bounds checks elided
+		self.addr = 'i64' if memory64 else 'i32'
+		# The memory type imported has to match the limits the memory was created with
+		self.max_pages = MAX_PAGES64 if memory64 else MAX_PAGES
 		self._level = 0
 		self._suffix = 0
 		self._imports = []
 		self._globals = []
+		self._params = []
 		self._variables = []
 		self._instructions = []
+		self._funcs = []
 
 	def add_src(self, src_loc):
 		if src_loc:
@@ -111,6 +121,21 @@ class _WASMEmitter:
 		self._instructions.append(code)
 		self._instructions.append('\n')
 
+	def address(self, value):
+		return f'({self.addr}.const {value})'
+
+	def load_slot(self, state, index, offset):
+		return f'({WASM_SLOT_LOAD[state.slot_size(index)]} {self.address(offset)})'
+
+	def set_slot(self, state, index, value):
+		next_off  = self.address(state.next_offset(index))
+		dirty_off = self.address(state.dirty_offset(index))
+		dirty_bit = f'(i64.const {state.dirty_bit(index):#x})'
+		self.append(f'(call $slots_set{state.slot_size(index)} {next_off} {dirty_off} {dirty_bit} {value})')
+
+	def add_param(self, name):
+		self._params.append(f'(param ${name} i64) ')
+
 	def add_variable(self, name):
 		self._variables.append('\t\t')
 		self._variables.append(f'(local ${name} i64)')
@@ -129,15 +154,35 @@ class _WASMEmitter:
 		yield
 		self._level -= 1
 
-	def flush(self, result: bool = False):
+	def end_func(self, name: str = 'run', results: int = 0):
+		# Wrap everything emitted since the last function up into one exported as `name`
+		func = f'\t(func (export "{name}") {"".join(self._params)}(result {" ".join(["i64"] * max(results, 1))})\n'
+		func += ''.join(self._variables)
+		func += ''.join(self._instructions)
+		if not results:
+			func += '\t\t(i64.const 0)\n'
+		func += '\n\t)\n'
+		self._funcs.append(func)
+
+		self._params.clear()
+		self._variables.clear()
+		self._instructions.clear()
+
+	def flush(self, results: int = 0):
+		# Modules with a single function don't need to end it first, it gets exported as `run`
+		if not self._funcs:
+			self.end_func(results = results)
+
 		module = '(module\n'
-		module += '\t(import "" "gmem" (memory $gmem i64 0 2 shared ))\n'
-		module += '\t(func $slots_set_py (import "" "slots_set_py") (param i64) (param i64))\n'
+		module += f'\t(import "" "gmem" (memory $gmem {self.addr} 0 {self.max_pages} shared ))\n'
 		module += ''.join(self._globals)
 		module += '\n'
 		module += ''.join(self._imports)
 		module += '\n'
-		module += WASM_SET_SLOT
+		for size, load in WASM_SLOT_LOAD.items():
+			module += WASM_SET_SLOT.format(
+				size = size, addr = self.addr, mask = (1 << (size * 8)) - 1, load = load, store = WASM_SLOT_STORE[size]
+			)
 		module += '\n'
 		module += WASM_SIGN
 		module += '\n'
@@ -145,14 +190,10 @@ class _WASMEmitter:
 		module += '\n'
 		module += WASM_ZMOD
 		module += '\n'
-		module += '\t(func (export "run") (result i64)\n'
-		module += ''.join(self._variables)
-		module += ''.join(self._instructions)
-		if not result:
-			module += '\t\t(i64.const 0)\n'
-		module += "\n\t)\n)\n"
+		module += ''.join(self._funcs)
+		module += ')\n'
 
-		self._instructions.clear()
+		self._funcs.clear()
 		return module
 
 class _Compiler:
@@ -208,7 +249,8 @@ class _RHSValueCompiler(_ValueCompiler):
 			self.inputs.add(value)
 
 		if self.mode == 'curr':
-			return f'(i64.load (i64.const {self.state.get_signal(value) * 16}))'
+			signal_index = self.state.get_signal(value)
+			return self.emitter.load_slot(self.state, signal_index, self.state.curr_offset(signal_index))
 		else:
 			return f'(local.get $next_{self.state.get_signal(value)})'
 
@@ -332,11 +374,17 @@ class _RHSValueCompiler(_ValueCompiler):
 
 	@classmethod
 	def compile(cls, state, value, *, mode):
-		emitter = _WASMEmitter()
+		return cls.compile_many(state, (value,), mode = mode)
+
+	@classmethod
+	def compile_many(cls, state, values, *, mode):
+		# Every value is left on the stack in order, and returned together as a multi-value result
+		emitter = _WASMEmitter(memory64 = state.memory64)
 		compiler = cls(state, emitter, mode = mode)
-		emitter.append(compiler(value))
+		for value in values:
+			emitter.append(compiler(value))
 
-		output_code = emitter.flush(True)
+		output_code = emitter.flush(len(values))
 		return output_code
 
 class _LHSValueCompiler(_ValueCompiler):
@@ -493,32 +541,156 @@ class _StatementCompiler(StatementVisitor, _Compiler):
 		raise NotImplementedError # :nocov:
 
 	@classmethod
-	def compile(cls, state, stmt):
-		output_indexes = [state.get_signal(signal) for signal in stmt._lhs_signals()]
-		emitter = _WASMEmitter()
+	def _compile(cls, state, signals, body):
+		output_indexes = [state.get_signal(signal) for signal in signals]
+		emitter = _WASMEmitter(memory64 = state.memory64)
 		for signal_index in output_indexes:
 			emitter.add_variable(f'next_{signal_index}')
-			emitter.append(f'(local.set $next_{signal_index} (i64.load (i64.const {(signal_index * 2 + 1) * 8})))')
-		compiler = cls(state, emitter)
-		compiler(stmt)
+			gen_next = emitter.load_slot(state, signal_index, state.next_offset(signal_index))
+			emitter.append(f'(local.set $next_{signal_index} {gen_next})')
+		body(cls(state, emitter))
 		for signal_index in output_indexes:
-			emitter.append(f'(call $slots_set (i64.const {signal_index}) (local.get $next_{signal_index}))')
+			emitter.set_slot(state, signal_index, f'(local.get $next_{signal_index})')
 
 		output_code = emitter.flush()
 		return output_code
 
+	@classmethod
+	def compile(cls, state, stmts):
+		# `stmts` is either a single statement or a list of them
+		signals = union((stmt._lhs_signals() for stmt in flatten([ stmts ])), start = SignalSet())
+		return cls._compile(state, signals, lambda compiler: compiler(stmts))
+
+	@classmethod
+	def compile_writes(cls, state, signals):
+		# Writes to the given signals, taking the values as parameters so the module can be reused
+		# for any of them. Later writes to the same signal win, the same as with statements.
+		def body(compiler):
+			for index, signal in enumerate(signals):
+				compiler.emitter.add_param(f'value_{index}')
+				compiler.lhs(signal)(f'(local.get $value_{index})')
+		return cls._compile(state, SignalSet(signals), body)
+
+def _single_case(switch, value):
+	# The statements of a switch with a single case matching only `value`, or None if it has others
+	if not isinstance(switch, Switch) or len(switch.cases) != 1:
+		return None
+
+	(patterns, case_stmts), = switch.cases.items()
+	if not patterns or any('-' in pattern or int(pattern or '0', 2) != value for pattern in patterns):
+		return None
+	return case_stmts
+
+def _enable_signal(stmts, signals, domain):
+	'''
+	Find the enable of a sync domain, if its statements end in the ``Switch(en, {0: [s.eq(s), ...]})``
+	that ``EnableInserter`` adds, holding every signal of the domain. While ``en`` is low nothing
+	that comes before it matters.
+
+	Lowering the domain appends the ``Switch(rst, {1: [s.eq(reset), ...]})`` for its reset after
+	that, which still applies while ``en`` is low, so it is looked past and returned along with the
+	enable, running the domain can then only be skipped while both are low.
+	'''
+
+	stmts = list(stmts)
+	reset = None
+	if domain.rst is not None and stmts and getattr(stmts[-1], 'test', None) is domain.rst:
+		case_stmts = _single_case(stmts[-1], 1)
+		if case_stmts is not None and all(
+			isinstance(stmt, Assign) and isinstance(stmt.rhs, Const) for stmt in case_stmts
+		):
+			reset = domain.rst
+			stmts.pop()
+
+	switch = stmts[-1] if stmts else None
+	case_stmts = _single_case(switch, 0)
+	if case_stmts is None or not isinstance(switch.test, Signal):
+		return None, None
+
+	held = SignalSet()
+	for stmt in case_stmts:
+		if not isinstance(stmt, Assign) or not isinstance(stmt.lhs, Signal) or stmt.rhs is not stmt.lhs:
+			return None, None
+		held.add(stmt.lhs)
+
+	return (switch.test, reset) if held == signals else (None, None)
+
 class WASMFragmentCompiler:
 	def __init__(self, state) -> None:
 		self.state = state
 
+	def allocate(self, fragment: Fragment):
+		# Give the signals driven by each domain their slots up front, so each domain's state ends
+		# up packed together rather than in whatever order the compiler first comes across it.
+		for domain_signals in fragment.drivers.values():
+			for signal in domain_signals:
+				self.state.get_signal(signal)
+
+		for subfragment, _ in fragment.subfragments:
+			self.allocate(subfragment)
+
 	def __call__(self, fragment: Fragment):
+		self.allocate(fragment)
+		return self.compile(fragment)
+
+	def partition(self, stmts, signals):
+		# Split the comb domain up into the groups of signals that are assigned together, so each
+		# group gets a process that is only woken up by the signals it reads. Groups that read the
+		# same signals would always be run together anyway, so those share a process.
+		analyzer = LHSGroupAnalyzer()
+		analyzer.on_statements(stmts)
+
+		# Sort the statements into their groups in a single pass, only a switch assigning signals
+		# of several groups has to be filtered down for each of them
+		group_stmts = OrderedDict()
+		for stmt in stmts:
+			groups = { analyzer.find(signal) for signal in stmt._lhs_signals() }
+			if len(groups) == 1:
+				group_stmts.setdefault(groups.pop(), []).append(stmt)
+				continue
+			for group in groups:
+				group_signals = SignalSet(signal for signal in stmt._lhs_signals() if analyzer.find(signal) == group)
+				group_stmts.setdefault(group, []).extend(LHSGroupFilter(group_signals)([ stmt ]))
+
+		partitions = OrderedDict()
+		for group, group_signals in analyzer.groups().items():
+			stmts  = group_stmts.get(group, [])
+			inputs = union((stmt._rhs_signals() for stmt in stmts), start = SignalSet())
+			key    = frozenset(self.state.get_signal(signal) for signal in inputs - group_signals)
+			partition = partitions.setdefault(key, (SignalSet(), []))
+			partition[0].update(group_signals)
+			partition[1].extend(stmts)
+
+		# Signals that are driven but never assigned just sit at their reset value
+		idle = SignalSet(signal for signal in signals if signal not in analyzer.signals)
+		if idle:
+			partitions.setdefault(frozenset(), (SignalSet(), []))[0].update(idle)
+
+		return partitions.values()
+
+	def compile(self, fragment: Fragment):
 		processes = set()
 
+		domains = []
 		for domain_name, domain_signals in fragment.drivers.items():
-			domain_stmts = LHSGroupFilter(domain_signals)(fragment.statements)
+			if domain_name is None:
+				comb_stmts = LHSGroupFilter(domain_signals)(fragment.statements)
+				for group, group_stmts in self.partition(comb_stmts, domain_signals):
+					domains.append((None, group, group_stmts))
+			else:
+				domains.append((domain_name, domain_signals, LHSGroupFilter(domain_signals)(fragment.statements)))
+
+		# Every process of the fragment is compiled into the same module, each as its own exported
+		# function, so there is one module to compile and one instance to keep around per fragment
+		emitter = _WASMEmitter(memory64 = self.state.memory64)
+		fragment_processes = []
+		for domain_name, domain_signals, domain_stmts in domains:
 			domain_process = WASMRTLProcess(is_comb = domain_name is None)
+			triggers = []
+			# Signals the next state of a sync domain depends on, and the signals enabling it
+			state_inputs = SignalSet()
+			enable = reset = None
 
-			emitter = _WASMEmitter()
 			if domain_name is None:
 				for signal in domain_signals:
 					signal_index = self.state.get_signal(signal)
@@ -529,38 +701,63 @@ class WASMFragmentCompiler:
 				_StatementCompiler(self.state, emitter, inputs = inputs)(domain_stmts)
 
 				for input in inputs:
-					self.state.add_trigger(domain_process, input)
+					triggers.append((input, None))
 			else:
 				domain = fragment.domains[domain_name]
 				clk_trigger = 1 if domain.clk_edge == 'pos' else 0
-				self.state.add_trigger(domain_process, domain.clk, trigger = clk_trigger)
+				triggers.append((domain.clk, clk_trigger))
 				if domain.rst is not None and domain.async_reset:
 					rst_trigger = 1
-					self.state.add_trigger(domain_process, domain.rst, trigger = rst_trigger)
+					triggers.append((domain.rst, rst_trigger))
 
 				for signal in domain_signals:
 					signal_index = self.state.get_signal(signal)
 					emitter.add_variable(f'next_{signal_index}')
-					index_const = f'(i64.const {(signal_index * 2 + 1) * 8})'
-					emitter.append(f'(local.set $next_{signal_index} (i64.load {index_const}))')
+					gen_next = emitter.load_slot(self.state, signal_index, self.state.next_offset(signal_index))
+					emitter.append(f'(local.set $next_{signal_index} {gen_next})')
+
+				_StatementCompiler(self.state, emitter, inputs = state_inputs)(domain_stmts)
 
-				_StatementCompiler(self.state, emitter)(domain_stmts)
+				# The next state only depends on the current one and the inputs, so if none of
+				# them changed since the last edge, or the domain isn't enabled, there is no need
+				# to run it at all.
+				state_inputs.update(domain_signals)
+				enable, reset = _enable_signal(domain_stmts, domain_signals, domain)
 
 			for signal in domain_signals:
 				signal_index = self.state.get_signal(signal)
-				emitter.append(f'(call $slots_set (i64.const {signal_index}) (local.get $next_{signal_index}))')
+				emitter.set_slot(self.state, signal_index, f'(local.get $next_{signal_index})')
 
+			emitter.end_func(f'run_{len(fragment_processes)}')
+			fragment_processes.append((domain_process, triggers, state_inputs, enable, reset))
+
+		if fragment_processes:
 			module_code = emitter.flush()
 			if getenv('TORII_WASMSIM_DUMP'):
 				file = NamedTemporaryFile('w', prefix = 'torii_wasmsim_', delete = False)
 				file.write(module_code)
 
-			domain_process.run = WASMRunner(module_code, self.state.memory, self.state.set_slot)
+			runners = WASMRunner.exports(
+				module_code, self.state.memory, [ f'run_{index}' for index in range(len(fragment_processes)) ]
+			)
+		else:
+			runners = []
+
+		# The processes are run natively by the scheduler, so they only need to be registered once
+		# the runners for them exist, their sensitivities never change so they go in the fanout table.
+		for (domain_process, triggers, state_inputs, enable, reset), runner in zip(fragment_processes, runners):
+			self.state.add_process(domain_process, runner)
+			for signal, trigger in triggers:
+				self.state.add_fanout(domain_process, signal, trigger = trigger)
+			for signal in state_inputs:
+				self.state.add_input(domain_process, signal)
+			if enable is not None:
+				self.state.set_enable(domain_process, enable, reset = reset)
 			processes.add(domain_process)
 
 		for subfragment_index, (subfragment, subfragment_name) in enumerate(fragment.subfragments):
 			if subfragment_name is None:
 				subfragment_name = f'U${subfragment_index}'
-			processes.update(self(subfragment))
+			processes.update(self.compile(subfragment))
 
 		return processes
@@ -4,6 +4,8 @@ use std::path::PathBuf;
 
 use pyo3::prelude::*;
 
+use crate::memory::{MAX_PAGES64, PAGE_SIZE};
+
 #[pyclass(from_py_object, eq, eq_int)]
 #[derive(PartialEq, Clone, Copy)]
 #[allow(non_camel_case_types, clippy::upper_case_acronyms)]
@@ -71,6 +73,9 @@ pub struct WASMConfig {
     coredump_on_trap: bool,
     inlining: bool,
     cache_path: Option<PathBuf>,
+    /// Use 64-bit linear memory, only needed if the simulation state doesn't fit in 4GiB. A 64-bit
+    /// memory can grow up to 64GiB, all of which is reserved as address space up front.
+    memory64: bool,
 }
 
 #[pymethods]
@@ -78,7 +83,7 @@ impl WASMConfig {
     #[new]
     #[pyo3(signature = (
 		backend = Backend::WINCH, opt_level = OptLevel::SPEED, profiler = Profiler::NONE, max_stack = 524288,
-		coredump_on_trap = false, inlining = false, cache_path = None,
+		coredump_on_trap = false, inlining = false, cache_path = None, memory64 = false,
 	))]
     #[allow(clippy::too_many_arguments)]
     fn new(
@@ -89,6 +94,7 @@ impl WASMConfig {
         coredump_on_trap: bool,
         inlining: bool,
         cache_path: Option<PathBuf>,
+        memory64: bool,
     ) -> Self {
         WASMConfig {
             backend,
@@ -98,6 +104,7 @@ impl WASMConfig {
             coredump_on_trap,
             inlining,
             cache_path,
+            memory64,
         }
     }
 }
@@ -112,15 +119,23 @@ impl Default for WASMConfig {
             coredump_on_trap: false,
             inlining: false,
             cache_path: None,
+            memory64: false,
         }
     }
 }
 
+impl WASMConfig {
+    pub fn memory64(&self) -> bool {
+        self.memory64
+    }
+}
+
 impl From<WASMConfig> for ::wasmtime::Config {
     fn from(value: WASMConfig) -> Self {
-        ::wasmtime::Config::new()
+        let mut config = ::wasmtime::Config::new();
+        config
             .max_wasm_stack(value.max_stack)
-            .wasm_memory64(true)
+            .wasm_memory64(value.memory64)
             .shared_memory(true)
             .strategy(match value.backend {
                 Backend::WINCH => ::wasmtime::Strategy::Winch,
@@ -142,7 +157,12 @@ impl From<WASMConfig> for ::wasmtime::Config {
             .cache(value.cache_path.map(|v| {
                 ::wasmtime::Cache::new(::wasmtime::CacheConfig::new().with_directory(v).to_owned())
                     .unwrap()
-            }))
-            .to_owned()
+            }));
+        // Shared memories can't move once created, so the whole of the largest a 64-bit memory can
+        // grow to has to fit in the address space reserved for it, which is only 4GiB by default
+        if value.memory64 {
+            config.memory_reservation(MAX_PAGES64 * PAGE_SIZE as u64);
+        }
+        config
     }
 }
@@ -5,6 +5,9 @@ use pyo3::prelude::*;
 mod config;
 mod memory;
 mod runner;
+mod scheduler;
+mod slots;
+mod timeline;
 
 #[pymodule]
 #[pyo3(name = "_wasm_engine")]
@@ -18,11 +21,12 @@ mod wasm_engine {
     #[pymodule_init]
     fn init(m: &Bound<'_, PyModule>) -> PyResult<()> {
         m.add("__version__", env!("CARGO_PKG_VERSION"))?;
+        m.add("MAX_PAGES", memory::MAX_PAGES)?;
+        m.add("MAX_PAGES64", memory::MAX_PAGES64)?;
         m.add_class::<config::Backend>()?;
         m.add_class::<config::OptLevel>()?;
         m.add_class::<config::Profiler>()?;
         m.add_class::<config::WASMConfig>()?;
-        m.add_class::<memory::WASMValue>()?;
         m.add_class::<memory::WASMInstance>()?;
         m.add_class::<runner::WASMRunner>()?;
         Ok(())
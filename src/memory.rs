@@ -1,14 +1,142 @@
 // SPDX-License-Identifier: BSD-2-Clause
 
+use std::cell::UnsafeCell;
+use std::ffi::{c_int, c_void};
+use std::ptr;
+
+use pyo3::exceptions::{PyBufferError, PyOverflowError, PyRuntimeError, PyValueError};
+use pyo3::ffi;
 use pyo3::prelude::*;
-use wasmtime::{Engine, MemoryTypeBuilder, SharedMemory, Store};
+use wasmtime::{Engine, Func, Instance, MemoryTypeBuilder, Module, SharedMemory, Store};
 
 use crate::config::WASMConfig;
+use crate::runner::WASMRunner;
+use crate::scheduler::Scheduler;
+use crate::slots::SlotTable;
+
+/// Size of a wasm page in bytes
+pub const PAGE_SIZE: usize = 65536;
+/// Largest the simulation memory is allowed to grow to, in pages. Shared memories can't move once
+/// created so this much address space is reserved up front, but only the pages in use get touched.
+/// This is all of the 4GiB a 32-bit memory can address.
+pub const MAX_PAGES: u64 = 65536;
+/// Largest a 64-bit simulation memory is allowed to grow to, in pages, 64GiB
+pub const MAX_PAGES64: u64 = 1 << 20;
+/// Number of instances the transient store takes before it's replaced with a fresh one
+const TRANSIENT_INSTANCES: usize = 1024;
+
+/// Loads a little endian value of `size` bytes from the memory, zero extended
+pub fn load_sized(memory: &SharedMemory, offset: usize, size: usize) -> u64 {
+    let data = memory.data();
+    assert!(
+        offset + size <= data.len(),
+        "slot offset {offset} is out of bounds"
+    );
+    // wasm values are always little endian
+    unsafe {
+        let ptr = UnsafeCell::raw_get(data.as_ptr().add(offset));
+        match size {
+            1 => ptr.read() as u64,
+            2 => u16::from_le(ptr.cast::<u16>().read_unaligned()) as u64,
+            4 => u32::from_le(ptr.cast::<u32>().read_unaligned()) as u64,
+            _ => u64::from_le(ptr.cast::<u64>().read_unaligned()),
+        }
+    }
+}
+
+/// Stores the low `size` bytes of the value to the memory
+pub fn store_sized(memory: &SharedMemory, offset: usize, size: usize, value: u64) {
+    let data = memory.data();
+    assert!(
+        offset + size <= data.len(),
+        "slot offset {offset} is out of bounds"
+    );
+    unsafe {
+        let ptr = UnsafeCell::raw_get(data.as_ptr().add(offset));
+        match size {
+            1 => ptr.write(value as u8),
+            2 => ptr.cast::<u16>().write_unaligned((value as u16).to_le()),
+            4 => ptr.cast::<u32>().write_unaligned((value as u32).to_le()),
+            _ => ptr.cast::<u64>().write_unaligned(value.to_le()),
+        }
+    }
+}
+
+pub fn load(memory: &SharedMemory, offset: usize) -> u64 {
+    load_sized(memory, offset, 8)
+}
+
+pub fn store(memory: &SharedMemory, offset: usize, value: u64) {
+    store_sized(memory, offset, 8, value)
+}
+
+/// Marks a slot as dirty, the same way the generated `$slots_set` does
+pub fn mark_dirty(memory: &SharedMemory, slots: &SlotTable, slot: usize) {
+    let offset = slots.dirty_offset(slot);
+    store(memory, offset, load(memory, offset) | slots.dirty_bit(slot));
+}
 
 #[pyclass]
 pub struct WASMInstance {
     pub memory: SharedMemory,
     pub store: Store<()>,
+    /// Store for the modules only ever run from Python, like the commands of coroutine processes.
+    /// A store never frees the instances in it, so this one gets replaced every so often.
+    pub transient: Store<()>,
+    /// Bumped every time the transient store is replaced
+    pub generation: u64,
+    transient_instances: usize,
+    pub scheduler: Scheduler,
+    /// Whether the linear memory is 64-bit, generated code has to use matching address types
+    memory64: bool,
+}
+
+impl WASMInstance {
+    /// Instantiates the module in the main store, or in the transient store, returning the
+    /// functions it exports under the given names. Runners from a transient store that got
+    /// replaced have to be instantiated again.
+    pub fn instantiate(&mut self, module: &Module, transient: bool, names: &[String]) -> Vec<Func> {
+        let store = if transient {
+            if self.transient_instances >= TRANSIENT_INSTANCES {
+                self.recycle_transient();
+            }
+            self.transient_instances += 1;
+            &mut self.transient
+        } else {
+            &mut self.store
+        };
+
+        let imports = [self.memory.clone().into()];
+        let instance = Instance::new(&mut *store, module, &imports).unwrap();
+        names
+            .iter()
+            .map(|name| instance.get_func(&mut *store, name).unwrap())
+            .collect()
+    }
+
+    /// Replaces the transient store with a fresh one. The conditions processes are waiting on are
+    /// evaluated in it, so those get instantiated again in the new store.
+    fn recycle_transient(&mut self) {
+        let Self {
+            memory,
+            store,
+            transient,
+            generation,
+            transient_instances,
+            scheduler,
+            ..
+        } = self;
+        *transient = Store::new(store.engine(), ());
+        *generation += 1;
+        *transient_instances = 0;
+
+        for (module, runner) in scheduler.conditions_mut() {
+            let imports = [memory.clone().into()];
+            let instance = Instance::new(&mut *transient, module, &imports).unwrap();
+            *runner = instance.get_typed_func(&mut *transient, "run").unwrap();
+            *transient_instances += 1;
+        }
+    }
 }
 
 #[pymethods]
@@ -17,49 +145,402 @@ impl WASMInstance {
     #[pyo3(signature = (config = None))]
     fn new(config: Option<WASMConfig>) -> Self {
         let runtime_config = config.unwrap_or_default();
+        // 32-bit memories get their bounds checks elided by guard pages, 64-bit ones don't
+        let memory64 = runtime_config.memory64();
 
         let engine = Engine::new(&runtime_config.into()).unwrap();
-        let mut store = Store::new(&engine, ());
+        let store = Store::new(&engine, ());
+        let transient = Store::new(&engine, ());
 
         let mem_type = MemoryTypeBuilder::new()
-            .memory64(true)
+            .memory64(memory64)
             .shared(true)
-            .min(2)
-            .max(Some(2))
+            .min(0)
+            .max(Some(if memory64 { MAX_PAGES64 } else { MAX_PAGES }))
             .build()
             .unwrap();
         let memory = SharedMemory::new(&engine, mem_type).unwrap();
-        Self { memory, store }
+
+        Self {
+            memory,
+            store,
+            transient,
+            generation: 0,
+            transient_instances: 0,
+            scheduler: Scheduler::default(),
+            memory64,
+        }
     }
-}
 
-#[pyclass]
-pub struct WASMValue {
-    /// Pointer to the wasm value, unsafely as usize as *mut u8 makes pyo3 unhappy
-    ptr: usize,
-    /// Value length in bits
-    length: u64,
-}
+    /// Registers a new signal slot of the given width and reset value, returning its index.
+    /// Memory is grown a page at a time as the slot groups fill it up.
+    fn add_slot(&mut self, width: u32, reset: i64) -> PyResult<u32> {
+        let end = self.scheduler.slots.end_with(width);
+        let size = self.memory.data().len();
+        if end > size {
+            let pages = (end - size).div_ceil(PAGE_SIZE) as u64;
+            if self.memory.grow(pages).is_err() {
+                return Err(PyOverflowError::new_err(format!(
+                    "Unable to allocate slot {}, the simulation memory is full",
+                    self.scheduler.slots.len()
+                )));
+            }
+        }
 
-#[pymethods]
-impl WASMValue {
-    #[new]
-    pub fn new(instance: &WASMInstance, length: u64, offset: usize, value: u64) -> Self {
-        let ptr = unsafe { instance.memory.data().as_ptr().add(offset * 8) as usize };
-        let new = Self { ptr, length };
-        new.set(value);
-        new
+        let slot = self.scheduler.add_slot(width) as usize;
+        let slots = &self.scheduler.slots;
+        let reset = reset as u64 & slots.mask(slot);
+        store_sized(
+            &self.memory,
+            slots.curr_offset(slot),
+            slots.size(slot),
+            reset,
+        );
+        store_sized(
+            &self.memory,
+            slots.next_offset(slot),
+            slots.size(slot),
+            reset,
+        );
+        Ok(slot as u32)
+    }
+
+    /// Byte offset of the current value of the given slot
+    fn curr_offset(&self, slot: u32) -> usize {
+        self.scheduler.slots.curr_offset(slot as usize)
+    }
+
+    /// Byte offset of the next value of the given slot
+    fn next_offset(&self, slot: u32) -> usize {
+        self.scheduler.slots.next_offset(slot as usize)
+    }
+
+    /// Byte offset of the dirty bitmap word for the given slot
+    fn dirty_offset(&self, slot: u32) -> usize {
+        self.scheduler.slots.dirty_offset(slot as usize)
+    }
+
+    /// Bit for the given slot in its dirty bitmap word
+    fn dirty_bit(&self, slot: u32) -> u64 {
+        self.scheduler.slots.dirty_bit(slot as usize)
+    }
+
+    /// Storage size of the given slot in bytes
+    fn slot_size(&self, slot: u32) -> usize {
+        self.scheduler.slots.size(slot as usize)
+    }
+
+    /// Registers a new process, returning its index. Processes without a runner are handed back
+    /// to Python by `settle` when they become runnable.
+    #[pyo3(signature = (runner = None))]
+    fn add_process(&mut self, runner: Option<PyRef<'_, WASMRunner>>) -> PyResult<u32> {
+        let runner = runner.map(|runner| runner.typed()).transpose()?;
+        Ok(self.scheduler.add_process(runner))
+    }
+
+    fn wake(&mut self, process: u32) {
+        self.scheduler.wake(process);
+    }
+
+    /// Adds a static sensitivity of a process to a slot, used for the RTL processes
+    #[pyo3(signature = (process, slot, trigger = None))]
+    fn add_fanout(&mut self, process: u32, slot: u32, trigger: Option<u32>) {
+        self.scheduler.add_fanout(process, slot, trigger);
+    }
+
+    /// Adds an input of a process, runs of the process are skipped while none of its inputs
+    /// changed since it last ran, see `Scheduler::add_input`
+    fn add_input(&mut self, process: u32, slot: u32) {
+        self.scheduler.add_input(process, slot);
     }
 
-    pub fn set(&self, value: u64) {
-        // make sure the value is always fits the bits
-        let value = value & ((1 << self.length) - 1);
-        // TODO: fix for big as wasm values are always little endian
-        unsafe { *(self.ptr as *mut u64) = value };
+    /// Sets the slot enabling a process, runs of the process are skipped while it reads zero,
+    /// unless the given reset slot is set
+    #[pyo3(signature = (process, slot, reset = None))]
+    fn set_enable(&mut self, process: u32, slot: u32, reset: Option<u32>) {
+        self.scheduler.set_enable(process, slot, reset);
     }
 
-    pub fn get(&self) -> u64 {
-        // TODO: fix for big endian as value here is always little endian
-        unsafe { *(self.ptr as *mut u64) }
+    /// Makes a process wait on the condition computed by `runner`, it is only handed back by
+    /// `settle` once the condition is non-zero when it wakes up, or after `timeout` wake ups
+    #[pyo3(signature = (process, runner, timeout = None))]
+    fn wait_until(
+        &mut self,
+        process: u32,
+        mut runner: PyRefMut<'_, WASMRunner>,
+        timeout: Option<u64>,
+    ) -> PyResult<()> {
+        if timeout == Some(0) {
+            return Err(PyValueError::new_err(
+                "Condition timeout must be greater than zero",
+            ));
+        }
+        let (module, condition) = runner.condition(self)?;
+        self.scheduler
+            .wait_until(process, module, condition, timeout);
+        Ok(())
     }
+
+    /// Makes a process sleep until it was woken up `count` times, it is only handed back by
+    /// `settle` on the last of them
+    fn wait_count(&mut self, process: u32, count: u64) -> PyResult<()> {
+        if count == 0 {
+            return Err(PyValueError::new_err(
+                "Wake up count must be greater than zero",
+            ));
+        }
+        self.scheduler.wait_count(process, count);
+        Ok(())
+    }
+
+    #[pyo3(signature = (process, slot, trigger = None))]
+    fn add_trigger(&mut self, process: u32, slot: u32, trigger: Option<u64>) -> PyResult<()> {
+        if !self.scheduler.add_trigger(process, slot, trigger) {
+            return Err(PyValueError::new_err("Unable to add trigger for process!"));
+        }
+        Ok(())
+    }
+
+    fn remove_trigger(&mut self, process: u32, slot: u32) -> PyResult<()> {
+        if !self.scheduler.remove_trigger(process, slot) {
+            return Err(PyValueError::new_err(format!(
+                "Unable to remove trigger for process {process}, not in the slot list"
+            )));
+        }
+        Ok(())
+    }
+
+    #[getter]
+    fn get_memory64(&self) -> bool {
+        self.memory64
+    }
+
+    #[getter]
+    fn get_now(&self) -> u64 {
+        self.scheduler.timeline.now
+    }
+
+    /// Schedules the process to be woken up after `interval`, or in the current timestep if it
+    /// is `None`
+    #[pyo3(signature = (process, interval = None))]
+    fn wait_interval(&mut self, process: u32, interval: Option<i64>) -> PyResult<()> {
+        let now = self.scheduler.timeline.now;
+        let run_at = now as i64 + interval.unwrap_or(0);
+        if run_at < now as i64 {
+            return Err(PyValueError::new_err(format!(
+                "Deadline of {run_at} is behind our current state of {now}"
+            )));
+        }
+        if !self.scheduler.wake_at(run_at as u64, process) {
+            return Err(PyValueError::new_err(format!(
+                "Process {process} already in deadline list"
+            )));
+        }
+        Ok(())
+    }
+
+    /// Adds a clock driving the given 1-bit slot natively, toggling it after `phase`, and from
+    /// then on every `half_period`
+    fn add_clock(&mut self, slot: u32, phase: u64, half_period: u64) -> PyResult<()> {
+        if half_period == 0 {
+            return Err(PyValueError::new_err(
+                "Clock half period must be greater than zero",
+            ));
+        }
+        self.scheduler.add_clock(slot, phase, half_period);
+        Ok(())
+    }
+
+    /// Time of the next deadline on the timeline, if there is any
+    #[getter]
+    fn get_deadline(&self) -> Option<u64> {
+        self.scheduler.timeline.next_deadline()
+    }
+
+    /// Moves time forward to the nearest deadline, returning false if there was none
+    fn advance(&mut self) -> bool {
+        self.scheduler.advance(&self.memory, true)
+    }
+
+    /// Sets the next value of the given slot, queueing it for the next commit if it changed
+    fn set_next(&mut self, slot: u32, value: u64) {
+        let slot = slot as usize;
+        let slots = &self.scheduler.slots;
+        let (offset, size) = (slots.next_offset(slot), slots.size(slot));
+        let value = value & slots.mask(slot);
+        if load_sized(&self.memory, offset, size) != value {
+            store_sized(&self.memory, offset, size, value);
+            mark_dirty(&self.memory, slots, slot);
+        }
+    }
+
+    fn get(&self, slot: u32) -> u64 {
+        let slot = slot as usize;
+        let slots = &self.scheduler.slots;
+        load_sized(&self.memory, slots.curr_offset(slot), slots.size(slot)) & slots.mask(slot)
+    }
+
+    /// Current values of every given slot
+    fn get_many(&self, slots: Vec<u32>) -> Vec<u64> {
+        slots.into_iter().map(|slot| self.get(slot)).collect()
+    }
+
+    /// Sets the next values of every given slot, see `set_next`
+    fn set_next_many(&mut self, slots: Vec<u32>, values: Vec<u64>) -> PyResult<()> {
+        if slots.len() != values.len() {
+            return Err(PyValueError::new_err(format!(
+                "Got {} values for {} slots",
+                values.len(),
+                slots.len()
+            )));
+        }
+        for (slot, value) in slots.into_iter().zip(values) {
+            self.set_next(slot, value);
+        }
+        Ok(())
+    }
+
+    /// Calls the runners of all the given processes in one go, every process must have a runner
+    fn run(&mut self, py: Python<'_>, processes: Vec<u32>) -> PyResult<()> {
+        if let Some(process) = processes
+            .iter()
+            .find(|&&process| !self.scheduler.has_runner(process))
+        {
+            return Err(PyValueError::new_err(format!(
+                "Process {process} has no runner and can't be run natively"
+            )));
+        }
+
+        // Nothing in here touches Python objects, so let other threads run in the meantime
+        let Self {
+            scheduler, store, ..
+        } = self;
+        py.detach(|| scheduler.run(store, &processes))
+            .map_err(|err| PyRuntimeError::new_err(err.to_string()))?;
+        Ok(())
+    }
+
+    /// Runs delta cycles until the design converges, see `Scheduler::settle`
+    fn settle(&mut self, py: Python<'_>) -> PyResult<Vec<u32>> {
+        let Self {
+            scheduler,
+            store,
+            transient,
+            memory,
+            ..
+        } = self;
+        py.detach(|| scheduler.settle(store, transient, memory))
+            .map_err(|err| PyRuntimeError::new_err(err.to_string()))
+    }
+
+    /// Runs until the clock in the given slot had `cycles` edges to `trigger`, see
+    /// `Scheduler::run_cycles`
+    fn run_cycles(
+        &mut self,
+        py: Python<'_>,
+        slot: u32,
+        trigger: u64,
+        cycles: u64,
+    ) -> PyResult<u64> {
+        if !self.scheduler.has_clock(slot) {
+            return Err(PyValueError::new_err(format!(
+                "Slot {slot} is not driven by a clock"
+            )));
+        }
+
+        let Self {
+            scheduler,
+            store,
+            transient,
+            memory,
+            ..
+        } = self;
+        py.detach(|| scheduler.run_cycles(store, transient, memory, slot, trigger, cycles))
+            .map_err(|err| PyRuntimeError::new_err(err.to_string()))
+    }
+
+    fn take_changed(&mut self) -> Vec<u32> {
+        self.scheduler.take_changed()
+    }
+
+    /// Whether idle time where only clocks are toggling gets skipped over when advancing
+    #[getter]
+    fn get_fast_forward(&self) -> bool {
+        self.scheduler.fast_forward
+    }
+
+    #[setter]
+    fn set_fast_forward(&mut self, fast_forward: bool) {
+        self.scheduler.fast_forward = fast_forward;
+    }
+
+    /// Number of times the runner of a process was called natively, runs that were skipped
+    /// aren't counted
+    #[getter]
+    fn get_runs(&self) -> u64 {
+        self.scheduler.runs
+    }
+
+    #[getter]
+    fn get_tracing(&self) -> bool {
+        self.scheduler.tracing
+    }
+
+    #[setter]
+    fn set_tracing(&mut self, tracing: bool) {
+        self.scheduler.tracing = tracing;
+    }
+
+    /// Exposes the linear memory as a writable buffer of bytes. The memory is reserved up front
+    /// so it never moves, but the buffer only covers what was in use when it was requested.
+    unsafe fn __getbuffer__(
+        slf: Bound<'_, Self>,
+        view: *mut ffi::Py_buffer,
+        flags: c_int,
+    ) -> PyResult<()> {
+        if view.is_null() {
+            return Err(PyBufferError::new_err("View is null"));
+        }
+
+        // Another thread may be running the simulation with the instance borrowed
+        let (buf, len) = {
+            let instance = slf.try_borrow().map_err(|_| {
+                PyBufferError::new_err("The simulation is already running in another thread")
+            })?;
+            let data = instance.memory.data();
+            (UnsafeCell::raw_get(data.as_ptr()), data.len())
+        };
+
+        // Safety: the view was checked above, and is filled in the way CPython expects
+        unsafe {
+            (*view).obj = slf.into_any().into_ptr();
+            (*view).buf = buf as *mut c_void;
+            (*view).len = len as isize;
+            (*view).readonly = 0;
+            (*view).itemsize = 1;
+            (*view).format = if flags & ffi::PyBUF_FORMAT == ffi::PyBUF_FORMAT {
+                c"B".as_ptr() as *mut _
+            } else {
+                ptr::null_mut()
+            };
+            (*view).ndim = 1;
+            (*view).shape = if flags & ffi::PyBUF_ND == ffi::PyBUF_ND {
+                &mut (*view).len
+            } else {
+                ptr::null_mut()
+            };
+            (*view).strides = if flags & ffi::PyBUF_STRIDES == ffi::PyBUF_STRIDES {
+                &mut (*view).itemsize
+            } else {
+                ptr::null_mut()
+            };
+            (*view).suboffsets = ptr::null_mut();
+            (*view).internal = ptr::null_mut();
+        }
+        Ok(())
+    }
+
+    /// Nothing to release, the memory outlives every view of it. This doesn't borrow the instance,
+    /// as a view may be released while another thread is running the simulation.
+    unsafe fn __releasebuffer__(_slf: Bound<'_, Self>, _view: *mut ffi::Py_buffer) {}
 }
@@ -1,44 +1,173 @@
+use pyo3::exceptions::{PyRuntimeError, PyTypeError};
 use pyo3::prelude::*;
-use wasmtime::{Caller, Func, Instance, Module, TypedFunc};
+use wasmtime::{Func, Module, Store, TypedFunc, Val};
 
 use crate::memory::WASMInstance;
 
+/// Borrows the instance to run a module in. The instance stays borrowed while the scheduler runs
+/// with the GIL released, so using the simulation from another thread meanwhile is an error.
+fn borrow_instance<'py>(
+    instance: &'py Py<WASMInstance>,
+    py: Python<'py>,
+) -> PyResult<PyRefMut<'py, WASMInstance>> {
+    instance
+        .try_borrow_mut(py)
+        .map_err(|_| PyRuntimeError::new_err("The simulation is already running in another thread"))
+}
+
 #[pyclass]
 pub struct WASMRunner {
+    /// Compiled module, kept around to instantiate it again once the transient store is replaced
+    module: Module,
+    /// Name the function is exported under
+    name: String,
     /// wasm function that gets extracted from the compiled module
-    runner: TypedFunc<(), u64>,
+    func: Func,
+    /// Typed handle on `func`, if it returns a single value
+    runner: Option<TypedFunc<(), u64>>,
+    /// Generation of the transient store the module is instantiated in, `None` if it is in the
+    /// main store
+    generation: Option<u64>,
     instance: Py<WASMInstance>,
 }
 
+impl WASMRunner {
+    /// Typed handle on the function for running it natively, which requires a single result and
+    /// the module being in the main store
+    pub fn typed(&self) -> PyResult<TypedFunc<(), u64>> {
+        if self.generation.is_some() {
+            return Err(PyTypeError::new_err(
+                "Transient runners can't be run natively",
+            ));
+        }
+        self.runner
+            .clone()
+            .ok_or_else(|| PyTypeError::new_err("Runner must return exactly one value"))
+    }
+
+    /// Compiles the module and instantiates it once, with a runner for each of the given exports
+    fn compile(
+        src: &str,
+        instance: Py<WASMInstance>,
+        transient: bool,
+        names: Vec<String>,
+    ) -> PyResult<Vec<Self>> {
+        Python::attach(|py| {
+            let mut wasm = borrow_instance(&instance, py)?;
+            // Compilation can take a while for big designs, don't hold up other threads while it runs
+            let engine = wasm.store.engine().clone();
+            let module = py.detach(|| Module::new(&engine, src)).unwrap();
+
+            let funcs = wasm.instantiate(&module, transient, &names);
+            let store = if transient {
+                &wasm.transient
+            } else {
+                &wasm.store
+            };
+            let generation = transient.then_some(wasm.generation);
+            Ok(names
+                .into_iter()
+                .zip(funcs)
+                .map(|(name, func)| Self {
+                    module: module.clone(),
+                    name,
+                    func,
+                    runner: func.typed(store).ok(),
+                    generation,
+                    instance: instance.clone_ref(py),
+                })
+                .collect())
+        })
+    }
+
+    /// Module and typed handle on the function for evaluating it natively as a condition, which
+    /// is done in the transient store so conditions don't pile up in the main one
+    pub fn condition(&mut self, wasm: &mut WASMInstance) -> PyResult<(Module, TypedFunc<(), u64>)> {
+        if self.generation.is_none() {
+            return Err(PyTypeError::new_err("Conditions must be transient runners"));
+        }
+        // Makes sure the function is from the current transient store
+        self.store(wasm);
+        let runner = self
+            .runner
+            .clone()
+            .ok_or_else(|| PyTypeError::new_err("Runner must return exactly one value"))?;
+        Ok((self.module.clone(), runner))
+    }
+
+    /// Returns the store to call the function in, instantiating the module again first if the
+    /// transient store it was in has since been replaced
+    fn store<'a>(&mut self, wasm: &'a mut WASMInstance) -> &'a mut Store<()> {
+        let Some(generation) = self.generation else {
+            return &mut wasm.store;
+        };
+        if generation != wasm.generation {
+            self.func = wasm.instantiate(&self.module, true, std::slice::from_ref(&self.name))[0];
+            self.runner = self.func.typed(&wasm.transient).ok();
+            self.generation = Some(wasm.generation);
+        }
+        &mut wasm.transient
+    }
+}
+
 #[pymethods]
 impl WASMRunner {
+    /// Compiles and instantiates the module, transient runners go in a store that gets replaced
+    /// every so often, so they can't be the runners of processes
     #[new]
-    fn new(src: &str, instance: Py<WASMInstance>, callback: Py<PyAny>) -> Self {
-        let runner = Python::attach(|py| {
-            let mut wasm = instance.try_borrow_mut(py).unwrap();
-            let module = Module::new(wasm.store.engine(), src).unwrap();
-
-            let py_callback = Func::wrap(
-                &mut wasm.store,
-                move |_: Caller<'_, ()>, index: u64, value: u64| {
-                    Python::attach(|py| {
-                        callback.call1(py, (index, value)).unwrap();
-                    });
-                },
-            );
+    #[pyo3(signature = (src, instance, transient = false))]
+    fn new(src: &str, instance: Py<WASMInstance>, transient: bool) -> PyResult<Self> {
+        let runner = Self::compile(src, instance, transient, vec!["run".to_string()])?;
+        Ok(runner.into_iter().next().unwrap())
+    }
 
-            let imports = [wasm.memory.clone().into(), py_callback.into()];
-            let inst = Instance::new(&mut wasm.store, &module, &imports).unwrap();
-            inst.get_typed_func(&mut wasm.store, "run").unwrap()
-        });
+    /// Compiles and instantiates the module in the main store once, returning a runner for each
+    /// of the functions it exports under the given names. Processes compiled together this way
+    /// share a single module and instance.
+    #[staticmethod]
+    fn exports(src: &str, instance: Py<WASMInstance>, names: Vec<String>) -> PyResult<Vec<Self>> {
+        Self::compile(src, instance, false, names)
+    }
 
-        Self { runner, instance }
+    fn __call__(&mut self) -> PyResult<u64> {
+        Python::attach(|py| {
+            // Borrowed through a new reference, so the store can be looked up through `self`
+            let instance = self.instance.clone_ref(py);
+            let mut wasm = borrow_instance(&instance, py)?;
+            let store = self.store(&mut wasm);
+            let runner = self
+                .runner
+                .as_ref()
+                .ok_or_else(|| PyTypeError::new_err("Runner must return exactly one value"))?;
+            Ok(runner.call(store, ()).unwrap())
+        })
     }
 
-    fn __call__(&mut self) -> u64 {
+    /// Calls the runner with the given parameters, returning every value it returned. Used for
+    /// modules that compute several values, or take what to write as parameters.
+    #[pyo3(signature = (params = Vec::new()))]
+    fn values(&mut self, params: Vec<u64>) -> PyResult<Vec<u64>> {
         Python::attach(|py| {
-            let mut wasm = self.instance.try_borrow_mut(py).unwrap();
-            self.runner.call(&mut wasm.store, ()).unwrap()
+            // Borrowed through a new reference, so the store can be looked up through `self`
+            let instance = self.instance.clone_ref(py);
+            let mut wasm = borrow_instance(&instance, py)?;
+            let store = self.store(&mut wasm);
+            let ty = self.func.ty(&*store);
+            if ty.params().len() != params.len() {
+                return Err(PyTypeError::new_err(format!(
+                    "Runner takes {} parameters, not {}",
+                    ty.params().len(),
+                    params.len()
+                )));
+            }
+
+            let params: Vec<Val> = params.iter().map(|&param| Val::I64(param as i64)).collect();
+            let mut results = vec![Val::I64(0); ty.results().len()];
+            self.func.call(&mut *store, &params, &mut results).unwrap();
+            Ok(results
+                .iter()
+                .map(|value| value.unwrap_i64() as u64)
+                .collect())
         })
     }
 }
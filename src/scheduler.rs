@@ -0,0 +1,633 @@
+// SPDX-License-Identifier: BSD-2-Clause
+
+use wasmtime::{Module, SharedMemory, Store, TypedFunc};
+
+use crate::memory::{load, load_sized, mark_dirty, store, store_sized};
+use crate::slots::SlotTable;
+use crate::timeline::Timeline;
+
+struct Process {
+    /// Compiled body for RTL processes, processes without one need to be run from Python
+    runner: Option<TypedFunc<(), u64>>,
+    runnable: bool,
+    /// Timer used for the deadlines of the process
+    timer: u32,
+    /// Whether changes to the inputs of the process are tracked, see `add_input`
+    tracked: bool,
+    /// Set if any input of the process changed since it last ran
+    stale: bool,
+    /// Slot that enables the process, it is skipped while the slot is zero, see `set_enable`
+    enable: Option<u32>,
+    /// Reset slot that overrides the enable, the process is never skipped while it is non-zero
+    reset: Option<u32>,
+    /// Condition the process is waiting on, see `wait_until`
+    condition: Option<Condition>,
+}
+
+/// Condition a process waits on, evaluated natively every time the process wakes up
+struct Condition {
+    /// Compiled condition, the process is only run once this returns non-zero. Without one the
+    /// process is run once the timeout runs out. The function lives in the transient store, the
+    /// module is kept to move it over whenever that store is replaced.
+    runner: Option<(Module, TypedFunc<(), u64>)>,
+    /// Number of wake ups left until the process is run regardless of the condition
+    timeout: Option<u64>,
+}
+
+/// What happens when a timer on the timeline expires
+#[derive(Clone, Copy)]
+enum Timer {
+    /// Wake up the given process
+    Process(u32),
+    /// Toggle the given 1-bit clock slot
+    Clock(u32),
+}
+
+struct Waiter {
+    process: u32,
+    trigger: Option<u64>,
+}
+
+/// Trigger value of a fanout edge that wakes the process on any change
+const ANY_TRIGGER: u32 = u32::MAX;
+/// Trigger value of a fanout edge that doesn't wake the process, only marks it as stale
+const INPUT_TRIGGER: u32 = u32::MAX - 1;
+
+/// Static edge from a slot to a process that is sensitive to it
+#[derive(Clone, Copy, Default)]
+struct Fanout {
+    process: u32,
+    trigger: u32,
+}
+
+/// Native delta-cycle scheduler, holds the slot table, the wait lists for every slot, and the
+/// process table along with the queue of processes that are ready to run.
+#[derive(Default)]
+pub struct Scheduler {
+    pub slots: SlotTable,
+    /// Compressed fanout table for the static sensitivities of the RTL processes, the edges for
+    /// slot `n` are `fanout[fanout_offsets[n]..fanout_offsets[n + 1]]`
+    fanout_offsets: Vec<u32>,
+    fanout: Vec<Fanout>,
+    /// Edges added since the fanout table was last built
+    new_fanout: Vec<(u32, Fanout)>,
+    /// Wait lists for the dynamic triggers coroutine processes add and remove as they run
+    waiters: Vec<Vec<Waiter>>,
+    processes: Vec<Process>,
+    ready: Vec<u32>,
+    pub timeline: Timeline,
+    timers: Vec<Timer>,
+    /// Set if we handed control back to Python mid delta-cycle and still need to commit
+    suspended: bool,
+    /// Processes that woke up in the middle of `run_cycles`, handed back by the next `settle`
+    pending: Vec<u32>,
+    /// If set, every slot that changed gets recorded until `take_changed` is called
+    pub tracing: bool,
+    changed: Vec<u32>,
+    changed_mask: Vec<bool>,
+    /// Whether each slot is driven by a clock
+    clocked: Vec<bool>,
+    /// Least common multiple of the periods of every clock, `u64::MAX` if it doesn't fit
+    hyperperiod: u64,
+    /// Set if anything other than a clock changed, or a Python process ran, in this time step
+    noisy: bool,
+    /// Start of the run of time steps where only clocks changed, if we are in one
+    quiet_since: Option<u64>,
+    /// Skip over idle time, see `skip_idle`
+    pub fast_forward: bool,
+    /// Number of times the runner of a process was called
+    pub runs: u64,
+}
+
+fn gcd(mut lhs: u64, mut rhs: u64) -> u64 {
+    while rhs != 0 {
+        (lhs, rhs) = (rhs, lhs % rhs);
+    }
+    lhs
+}
+
+impl Scheduler {
+    pub fn add_slot(&mut self, width: u32) -> u32 {
+        self.waiters.push(Vec::new());
+        self.changed_mask.push(false);
+        self.clocked.push(false);
+        self.slots.add(width)
+    }
+
+    pub fn add_process(&mut self, runner: Option<TypedFunc<(), u64>>) -> u32 {
+        let index = self.processes.len() as u32;
+        let timer = self.add_timer(Timer::Process(index));
+        self.processes.push(Process {
+            runner,
+            runnable: false,
+            timer,
+            tracked: false,
+            stale: true,
+            enable: None,
+            reset: None,
+            condition: None,
+        });
+        index
+    }
+
+    fn add_timer(&mut self, timer: Timer) -> u32 {
+        self.timers.push(timer);
+        self.timeline.add_timer()
+    }
+
+    /// Adds a clock that toggles the given slot after `phase`, and then every `half_period`,
+    /// without involving any process
+    pub fn add_clock(&mut self, slot: u32, phase: u64, half_period: u64) {
+        let timer = self.add_timer(Timer::Clock(slot));
+        self.timeline.every(phase, half_period, timer);
+        self.clocked[slot as usize] = true;
+
+        let period = half_period * 2;
+        self.hyperperiod = match self.hyperperiod {
+            0 => period,
+            u64::MAX => u64::MAX,
+            hyperperiod => (hyperperiod / gcd(hyperperiod, period))
+                .checked_mul(period)
+                .unwrap_or(u64::MAX),
+        };
+    }
+
+    /// Schedules the process to be woken up at the given time, returns false if it already is
+    pub fn wake_at(&mut self, run_at: u64, process: u32) -> bool {
+        let timer = self.processes[process as usize].timer;
+        self.timeline.at(run_at, timer)
+    }
+
+    /// Moves time forward to the nearest deadline, waking up every process waiting on it and
+    /// toggling every clock with an edge then. If `skip_idle` is set, idle time may be skipped
+    /// over to get there.
+    pub fn advance(&mut self, memory: &SharedMemory, skip_idle: bool) -> bool {
+        if std::mem::take(&mut self.noisy) {
+            self.quiet_since = None;
+        } else {
+            self.quiet_since.get_or_insert(self.timeline.now);
+        }
+        if skip_idle && self.fast_forward && !self.tracing {
+            self.skip_idle(memory);
+        }
+
+        let Self {
+            slots,
+            processes,
+            ready,
+            timeline,
+            timers,
+            ..
+        } = self;
+        timeline.advance(|timer| match timers[timer as usize] {
+            Timer::Process(process) => Self::wake_process(processes, ready, process),
+            Timer::Clock(slot) => {
+                let slot = slot as usize;
+                let (curr, next, size) = (
+                    slots.curr_offset(slot),
+                    slots.next_offset(slot),
+                    slots.size(slot),
+                );
+                store_sized(memory, next, size, load_sized(memory, curr, size) ^ 1);
+                mark_dirty(memory, slots, slot);
+            }
+        })
+    }
+
+    /// If nothing but the clocks changed for a whole period of every clock, the design is just
+    /// going around in circles, and will keep doing so until a Python process wakes up. In that
+    /// case jump straight to the next process deadline, flipping any clock that would have
+    /// toggled an odd number of times on the way, so the clocks keep their phase.
+    fn skip_idle(&mut self, memory: &SharedMemory) {
+        let Some(quiet_since) = self.quiet_since else {
+            return;
+        };
+        if self.timeline.now - quiet_since < self.hyperperiod {
+            return;
+        }
+
+        let Self {
+            slots,
+            timeline,
+            timers,
+            ..
+        } = self;
+        let Some(until) =
+            timeline.next_deadline_of(|timer| matches!(timers[timer as usize], Timer::Process(_)))
+        else {
+            return;
+        };
+        timeline.skip_to(until, |timer, count| {
+            if let Timer::Clock(slot) = timers[timer as usize]
+                && count % 2 == 1
+            {
+                // The clock is settled, so both halves of the slot hold the same value
+                let slot = slot as usize;
+                let (curr, next, size) = (
+                    slots.curr_offset(slot),
+                    slots.next_offset(slot),
+                    slots.size(slot),
+                );
+                let value = load_sized(memory, curr, size) ^ 1;
+                store_sized(memory, curr, size, value);
+                store_sized(memory, next, size, value);
+            }
+        });
+    }
+
+    pub fn wake(&mut self, process: u32) {
+        Self::wake_process(&mut self.processes, &mut self.ready, process);
+    }
+
+    fn wake_process(processes: &mut [Process], ready: &mut Vec<u32>, process: u32) {
+        let entry = &mut processes[process as usize];
+        if !entry.runnable {
+            entry.runnable = true;
+            ready.push(process);
+        }
+    }
+
+    /// Adds a static sensitivity of the given process to a slot, these are folded into the
+    /// fanout table and can't be removed again.
+    pub fn add_fanout(&mut self, process: u32, slot: u32, trigger: Option<u32>) {
+        self.new_fanout.push((
+            slot,
+            Fanout {
+                process,
+                trigger: trigger.unwrap_or(ANY_TRIGGER),
+            },
+        ));
+    }
+
+    /// Adds an input of the given process. Once a process has inputs, running it is skipped for
+    /// as long as none of them changed since it last ran, as it would only compute the same thing
+    /// again. This is only sound for processes with no state other than their inputs, the RTL
+    /// processes of sync domains list the signals they drive among their inputs for that reason.
+    pub fn add_input(&mut self, process: u32, slot: u32) {
+        self.processes[process as usize].tracked = true;
+        self.new_fanout.push((
+            slot,
+            Fanout {
+                process,
+                trigger: INPUT_TRIGGER,
+            },
+        ));
+    }
+
+    /// Sets the slot that enables the given process, running it is skipped while the slot is
+    /// zero. Only valid for processes that don't change anything while disabled, other than by
+    /// the given reset, so running it is never skipped while that is non-zero.
+    pub fn set_enable(&mut self, process: u32, slot: u32, reset: Option<u32>) {
+        let entry = &mut self.processes[process as usize];
+        entry.enable = Some(slot);
+        entry.reset = reset;
+    }
+
+    /// Makes the process wait on a condition, whenever it wakes up the condition is evaluated and
+    /// the process is only run if it is true, or once it woke up `timeout` times. The condition is
+    /// dropped as soon as the process runs. The condition is evaluated in the transient store.
+    pub fn wait_until(
+        &mut self,
+        process: u32,
+        module: Module,
+        runner: TypedFunc<(), u64>,
+        timeout: Option<u64>,
+    ) {
+        self.processes[process as usize].condition = Some(Condition {
+            runner: Some((module, runner)),
+            timeout,
+        });
+    }
+
+    /// Conditions processes are currently waiting on, for moving them to a new transient store
+    pub fn conditions_mut(&mut self) -> impl Iterator<Item = &mut (Module, TypedFunc<(), u64>)> {
+        self.processes
+            .iter_mut()
+            .filter_map(|process| process.condition.as_mut()?.runner.as_mut())
+    }
+
+    /// Makes the process sleep through its wake ups until it has been woken up `count` times
+    pub fn wait_count(&mut self, process: u32, count: u64) {
+        self.processes[process as usize].condition = Some(Condition {
+            runner: None,
+            timeout: Some(count),
+        });
+    }
+
+    /// Takes the process off the ready queue, returning whether it needs to be run at all
+    fn dequeue(
+        &mut self,
+        transient: &mut Store<()>,
+        memory: &SharedMemory,
+        process: u32,
+    ) -> wasmtime::Result<bool> {
+        let Self {
+            slots,
+            processes,
+            noisy,
+            ..
+        } = self;
+        let entry = &mut processes[process as usize];
+        entry.runnable = false;
+
+        let is_zero = |slot: u32| {
+            let slot = slot as usize;
+            load_sized(memory, slots.curr_offset(slot), slots.size(slot)) & slots.mask(slot) == 0
+        };
+        if let Some(enable) = entry.enable
+            && is_zero(enable)
+            && entry.reset.is_none_or(is_zero)
+        {
+            return Ok(false);
+        }
+        if let Some(condition) = &mut entry.condition {
+            let met = match &condition.runner {
+                Some((_, runner)) => runner.call(&mut *transient, ())? != 0,
+                None => false,
+            };
+            let expired = match &mut condition.timeout {
+                Some(timeout) => {
+                    // The wake ups being counted can't be skipped over as idle time
+                    *noisy = true;
+                    *timeout = timeout.saturating_sub(1);
+                    *timeout == 0
+                }
+                None => false,
+            };
+            if !met && !expired {
+                return Ok(false);
+            }
+            entry.condition = None;
+        }
+        Ok(!entry.tracked || std::mem::take(&mut entry.stale))
+    }
+
+    /// Rebuilds the fanout table from the current table and any newly added edges
+    fn build_fanout(&mut self) {
+        let slots = self.slots.len();
+        let old_slots = self.fanout_offsets.len().saturating_sub(1);
+
+        let mut offsets = vec![0u32; slots + 1];
+        for slot in 0..old_slots {
+            offsets[slot + 1] += self.fanout_offsets[slot + 1] - self.fanout_offsets[slot];
+        }
+        for &(slot, _) in &self.new_fanout {
+            offsets[slot as usize + 1] += 1;
+        }
+        for slot in 0..slots {
+            offsets[slot + 1] += offsets[slot];
+        }
+
+        let mut fanout = vec![Fanout::default(); offsets[slots] as usize];
+        let mut cursor = offsets.clone();
+        for slot in 0..old_slots {
+            let edges = self.fanout_offsets[slot] as usize..self.fanout_offsets[slot + 1] as usize;
+            for &edge in &self.fanout[edges] {
+                fanout[cursor[slot] as usize] = edge;
+                cursor[slot] += 1;
+            }
+        }
+        for (slot, edge) in self.new_fanout.drain(..) {
+            fanout[cursor[slot as usize] as usize] = edge;
+            cursor[slot as usize] += 1;
+        }
+
+        self.fanout_offsets = offsets;
+        self.fanout = fanout;
+    }
+
+    /// Adds a trigger for the given process, returns false if the process is already waiting on
+    /// the slot with a different trigger.
+    pub fn add_trigger(&mut self, process: u32, slot: u32, trigger: Option<u64>) -> bool {
+        let waiters = &mut self.waiters[slot as usize];
+        match waiters.iter().find(|waiter| waiter.process == process) {
+            Some(waiter) => waiter.trigger == trigger,
+            None => {
+                waiters.push(Waiter { process, trigger });
+                true
+            }
+        }
+    }
+
+    /// Removes the trigger for the given process, returns false if the process was not waiting
+    /// on the slot.
+    pub fn remove_trigger(&mut self, process: u32, slot: u32) -> bool {
+        let waiters = &mut self.waiters[slot as usize];
+        match waiters.iter().position(|waiter| waiter.process == process) {
+            Some(index) => {
+                waiters.swap_remove(index);
+                true
+            }
+            None => false,
+        }
+    }
+
+    pub fn take_changed(&mut self) -> Vec<u32> {
+        for &slot in &self.changed {
+            self.changed_mask[slot as usize] = false;
+        }
+        std::mem::take(&mut self.changed)
+    }
+
+    /// Apply every queued signal change, waking up any waiting processes
+    fn commit(&mut self, memory: &SharedMemory) -> bool {
+        let Self {
+            slots,
+            fanout_offsets,
+            fanout,
+            waiters,
+            processes,
+            ready,
+            tracing,
+            changed,
+            changed_mask,
+            clocked,
+            noisy,
+            ..
+        } = self;
+
+        // Walk the dirty bitmap a word at a time, only looking at the slots who's bits are set
+        let mut converged = true;
+        for group in &slots.groups {
+            let mut word = load(memory, group.offset);
+            if word == 0 {
+                continue;
+            }
+            store(memory, group.offset, 0);
+
+            while word != 0 {
+                let lane = word.trailing_zeros() as usize;
+                word &= word - 1;
+                let slot = group.slots[lane] as usize;
+
+                let next = load_sized(memory, group.next_offset(lane), group.size);
+                if load_sized(memory, group.curr_offset(lane), group.size) == next {
+                    continue;
+                }
+                store_sized(memory, group.curr_offset(lane), group.size, next);
+                if !clocked[slot] {
+                    *noisy = true;
+                }
+
+                if *tracing && !changed_mask[slot] {
+                    changed_mask[slot] = true;
+                    changed.push(slot as u32);
+                }
+
+                // Signed values are stored sign extended, triggers are always compared unsigned
+                let value = next & slots.mask(slot);
+                if slot + 1 < fanout_offsets.len() {
+                    let edges = fanout_offsets[slot] as usize..fanout_offsets[slot + 1] as usize;
+                    for edge in &fanout[edges] {
+                        if edge.trigger == INPUT_TRIGGER {
+                            processes[edge.process as usize].stale = true;
+                        } else if edge.trigger == ANY_TRIGGER || edge.trigger as u64 == value {
+                            Self::wake_process(processes, ready, edge.process);
+                            converged = false;
+                        }
+                    }
+                }
+                for waiter in &waiters[slot] {
+                    if waiter.trigger.is_none_or(|trigger| trigger == value) {
+                        Self::wake_process(processes, ready, waiter.process);
+                        converged = false;
+                    }
+                }
+            }
+        }
+
+        converged
+    }
+
+    /// Calls the runner of every given process in order, returning the processes that have no
+    /// runner and need to be run from Python instead.
+    pub fn run(
+        &mut self,
+        wasm_store: &mut Store<()>,
+        processes: &[u32],
+    ) -> wasmtime::Result<Vec<u32>> {
+        let mut foreign = Vec::new();
+        for &process in processes {
+            match &self.processes[process as usize].runner {
+                Some(runner) => {
+                    runner.call(&mut *wasm_store, ())?;
+                    self.runs += 1;
+                }
+                None => foreign.push(process),
+            }
+        }
+        Ok(foreign)
+    }
+
+    pub fn has_runner(&self, process: u32) -> bool {
+        self.processes[process as usize].runner.is_some()
+    }
+
+    /// Runs delta cycles until the design converges, returning an empty list. If a process that
+    /// has to be run from Python gets woken up, the cycle is suspended before the commit and the
+    /// list of those processes is returned instead, the next call then picks up where we left off.
+    pub fn settle(
+        &mut self,
+        wasm_store: &mut Store<()>,
+        transient: &mut Store<()>,
+        memory: &SharedMemory,
+    ) -> wasmtime::Result<Vec<u32>> {
+        if !self.new_fanout.is_empty() {
+            self.build_fanout();
+        }
+
+        if !self.pending.is_empty() {
+            return Ok(std::mem::take(&mut self.pending));
+        }
+
+        if self.suspended {
+            self.suspended = false;
+            if self.commit(memory) {
+                return Ok(Vec::new());
+            }
+        }
+
+        loop {
+            // 1. eval: run and suspend every non-waiting process once, queueing signal changes,
+            // leaving out the ones that would not change anything
+            let mut ready = std::mem::take(&mut self.ready);
+            let mut error = None;
+            ready.retain(|&process| match self.dequeue(transient, memory, process) {
+                Ok(run) => run,
+                Err(err) => {
+                    error.get_or_insert(err);
+                    false
+                }
+            });
+            if let Some(err) = error {
+                return Err(err);
+            }
+            let foreign = self.run(wasm_store, &ready)?;
+            // Hand the allocation back so the ready queue doesn't re-grow every delta cycle
+            self.ready = ready;
+            self.ready.clear();
+
+            if !foreign.is_empty() {
+                self.suspended = true;
+                self.noisy = true;
+                return Ok(foreign);
+            }
+
+            // 2. commit: apply every queued signal change, waking up any waiting processes
+            if self.commit(memory) {
+                return Ok(foreign);
+            }
+        }
+    }
+
+    /// Whether the given slot is driven by a clock on the timeline
+    pub fn has_clock(&self, slot: u32) -> bool {
+        self.timers
+            .iter()
+            .any(|timer| matches!(timer, Timer::Clock(clock) if *clock == slot))
+    }
+
+    /// Runs the simulation until the clock in `slot` had `cycles` edges to `trigger`, returning
+    /// the number of edges there were. This stops early if the timeline runs out, if a process
+    /// that has to be run from Python wakes up, which is then handed back by the next `settle`,
+    /// or after every time step while tracing, so the changes get written out at the right time.
+    pub fn run_cycles(
+        &mut self,
+        wasm_store: &mut Store<()>,
+        transient: &mut Store<()>,
+        memory: &SharedMemory,
+        slot: u32,
+        trigger: u64,
+        cycles: u64,
+    ) -> wasmtime::Result<u64> {
+        let slot = slot as usize;
+        let (curr, next, size) = (
+            self.slots.curr_offset(slot),
+            self.slots.next_offset(slot),
+            self.slots.size(slot),
+        );
+
+        let mut done = 0;
+        while done < cycles {
+            // Skipping idle time would skip over the edges we are counting
+            if !self.advance(memory, false) {
+                break;
+            }
+            // The clock only changes by its timer toggling it, so any change queued now is an edge
+            let value = load_sized(memory, next, size);
+            if value != load_sized(memory, curr, size) && value == trigger {
+                done += 1;
+            }
+
+            let foreign = self.settle(wasm_store, transient, memory)?;
+            if !foreign.is_empty() {
+                self.pending = foreign;
+                break;
+            }
+            if self.tracing {
+                break;
+            }
+        }
+        Ok(done)
+    }
+}
@@ -0,0 +1,146 @@
+// SPDX-License-Identifier: BSD-2-Clause
+
+/// Number of slots in a group, one for every bit of the group's dirty bitmap word
+const SLOT_GROUP: usize = 64;
+
+/// Storage sizes in bytes slots get packed into, narrow signals take up the smallest one that
+/// fits so more of them share a cache line
+const SLOT_SIZES: [usize; 4] = [1, 2, 4, 8];
+
+fn mask(width: u32) -> u64 {
+    match width {
+        width if width >= 64 => u64::MAX,
+        width => (1 << width) - 1,
+    }
+}
+
+fn size_class(width: u32) -> usize {
+    match width {
+        0..=8 => 0,
+        9..=16 => 1,
+        17..=32 => 2,
+        _ => 3,
+    }
+}
+
+/// Group of up to `SLOT_GROUP` slots of the same storage size. In memory the group is its dirty
+/// bitmap word, followed by the current value of every slot, and then the next values, so the
+/// commit streams through two dense arrays.
+pub struct SlotGroup {
+    /// Byte offset of the group in the simulation memory
+    pub offset: usize,
+    /// Storage size of every slot in the group, in bytes
+    pub size: usize,
+    /// Slot index for each lane of the group
+    pub slots: Vec<u32>,
+}
+
+impl SlotGroup {
+    fn len(size: usize) -> usize {
+        8 + SLOT_GROUP * size * 2
+    }
+
+    pub fn curr_offset(&self, lane: usize) -> usize {
+        self.offset + 8 + lane * self.size
+    }
+
+    pub fn next_offset(&self, lane: usize) -> usize {
+        self.offset + 8 + (SLOT_GROUP + lane) * self.size
+    }
+}
+
+#[derive(Clone, Copy)]
+struct Slot {
+    group: u32,
+    lane: u32,
+}
+
+/// Layout of every slot in the simulation memory. Groups are appended to the end of the used
+/// memory as they are needed, so offsets never change once handed out to generated code.
+#[derive(Default)]
+pub struct SlotTable {
+    /// Width of every slot in bits
+    widths: Vec<u32>,
+    slots: Vec<Slot>,
+    pub groups: Vec<SlotGroup>,
+    /// Group still being filled for each storage size
+    open: [Option<u32>; SLOT_SIZES.len()],
+    /// End of the memory used by the groups, in bytes
+    end: usize,
+}
+
+impl SlotTable {
+    pub fn len(&self) -> usize {
+        self.widths.len()
+    }
+
+    /// Size of the memory needed to hold every slot, if one more of the given width is added
+    pub fn end_with(&self, width: u32) -> usize {
+        let class = size_class(width);
+        match self.open[class] {
+            Some(_) => self.end,
+            None => self.end + SlotGroup::len(SLOT_SIZES[class]),
+        }
+    }
+
+    pub fn add(&mut self, width: u32) -> u32 {
+        let class = size_class(width);
+        let group = match self.open[class] {
+            Some(group) => group,
+            None => {
+                let size = SLOT_SIZES[class];
+                self.groups.push(SlotGroup {
+                    offset: self.end,
+                    size,
+                    slots: Vec::with_capacity(SLOT_GROUP),
+                });
+                self.end += SlotGroup::len(size);
+                (self.groups.len() - 1) as u32
+            }
+        };
+
+        let index = self.widths.len() as u32;
+        let entry = &mut self.groups[group as usize];
+        let lane = entry.slots.len() as u32;
+        entry.slots.push(index);
+        self.open[class] = (entry.slots.len() < SLOT_GROUP).then_some(group);
+
+        self.widths.push(width);
+        self.slots.push(Slot { group, lane });
+        index
+    }
+
+    pub fn mask(&self, slot: usize) -> u64 {
+        mask(self.widths[slot])
+    }
+
+    fn group(&self, slot: usize) -> (&SlotGroup, usize) {
+        let Slot { group, lane } = self.slots[slot];
+        (&self.groups[group as usize], lane as usize)
+    }
+
+    /// Storage size of the slot in bytes
+    pub fn size(&self, slot: usize) -> usize {
+        self.group(slot).0.size
+    }
+
+    pub fn curr_offset(&self, slot: usize) -> usize {
+        let (group, lane) = self.group(slot);
+        group.curr_offset(lane)
+    }
+
+    pub fn next_offset(&self, slot: usize) -> usize {
+        let (group, lane) = self.group(slot);
+        group.next_offset(lane)
+    }
+
+    /// Byte offset of the dirty bitmap word holding the bit for the given slot
+    pub fn dirty_offset(&self, slot: usize) -> usize {
+        self.group(slot).0.offset
+    }
+
+    /// Bit of the slot within its dirty bitmap word
+    pub fn dirty_bit(&self, slot: usize) -> u64 {
+        1 << self.group(slot).1
+    }
+}
@@ -0,0 +1,106 @@
+// SPDX-License-Identifier: BSD-2-Clause
+
+use std::cmp::Reverse;
+use std::collections::BinaryHeap;
+
+/// Simulation timeline, deadlines are kept in a min-heap so finding the next one to expire doesn't
+/// require looking at every waiting timer. All times are in integral picoseconds.
+#[derive(Default)]
+pub struct Timeline {
+    pub now: u64,
+    deadlines: BinaryHeap<Reverse<(u64, u32)>>,
+    /// Whether each timer currently has a deadline on the timeline
+    scheduled: Vec<bool>,
+    /// Re-arm interval for timers that expire periodically
+    periods: Vec<Option<u64>>,
+}
+
+impl Timeline {
+    /// Adds a new timer, returning its index
+    pub fn add_timer(&mut self) -> u32 {
+        self.scheduled.push(false);
+        self.periods.push(None);
+        (self.scheduled.len() - 1) as u32
+    }
+
+    /// Schedules the timer to expire once at the given time, returns false if the timer is
+    /// already on the timeline
+    pub fn at(&mut self, run_at: u64, timer: u32) -> bool {
+        let scheduled = &mut self.scheduled[timer as usize];
+        if *scheduled {
+            return false;
+        }
+        *scheduled = true;
+        self.deadlines.push(Reverse((run_at, timer)));
+        true
+    }
+
+    /// Schedules the timer to expire after `delay`, and from then on every `interval`
+    pub fn every(&mut self, delay: u64, interval: u64, timer: u32) -> bool {
+        if !self.at(self.now + delay, timer) {
+            return false;
+        }
+        self.periods[timer as usize] = Some(interval);
+        true
+    }
+
+    /// Time of the next deadline, if there is one
+    pub fn next_deadline(&self) -> Option<u64> {
+        self.deadlines
+            .peek()
+            .map(|Reverse((deadline, _))| *deadline)
+    }
+
+    /// Earliest deadline of any timer `filter` returns true for
+    pub fn next_deadline_of(&self, mut filter: impl FnMut(u32) -> bool) -> Option<u64> {
+        self.deadlines
+            .iter()
+            .filter(|Reverse((_, timer))| filter(*timer))
+            .map(|Reverse((deadline, _))| *deadline)
+            .min()
+    }
+
+    /// Moves every periodic timer that would expire before `until` forward to its first deadline
+    /// at or after it, passing each one moved along with the number of times it was skipped to
+    /// `skipped`. Every other timer must not expire before `until`.
+    pub fn skip_to(&mut self, until: u64, mut skipped: impl FnMut(u32, u64)) {
+        let deadlines = std::mem::take(&mut self.deadlines).into_vec();
+        self.deadlines = deadlines
+            .into_iter()
+            .map(
+                |Reverse((deadline, timer))| match self.periods[timer as usize] {
+                    Some(interval) if deadline < until => {
+                        let count = (until - deadline).div_ceil(interval);
+                        skipped(timer, count);
+                        Reverse((deadline + count * interval, timer))
+                    }
+                    _ => Reverse((deadline, timer)),
+                },
+            )
+            .collect();
+    }
+
+    /// Moves the timeline to the nearest deadline, passing every timer that expires then to
+    /// `expire`. Returns false if there was nothing left on the timeline.
+    pub fn advance(&mut self, mut expire: impl FnMut(u32)) -> bool {
+        let Some(deadline) = self.next_deadline() else {
+            return false;
+        };
+
+        while let Some(&Reverse((run_at, timer))) = self.deadlines.peek() {
+            if run_at != deadline {
+                break;
+            }
+            self.deadlines.pop();
+
+            match self.periods[timer as usize] {
+                Some(interval) => self.deadlines.push(Reverse((run_at + interval, timer))),
+                None => self.scheduled[timer as usize] = false,
+            }
+            expire(timer);
+        }
+        self.now = deadline;
+
+        true
+    }
+}